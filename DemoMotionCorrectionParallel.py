@@ -173,8 +173,7 @@ for f1 in  file_res:
             pl.cla()
         
 #%%
-import shutil
-names_new_each=[]
+fnames_new_each=[]
 for mov_names_each in movie_names:   
     movie_names_hdf5=[]
     for mov_name in mov_names_each:
@@ -183,14 +182,10 @@ for mov_names_each in movie_names:
         #idx_y=slice(12,500,None)
         #idx_xy=(idx_x,idx_y)
     idx_xy=None
-8    name_new.sort()    
-    names_new_each.append(name_new)
-    print name_new
-#%%
-fnames_new_each=dview.map_sync(cse.utilities.save_memmap_join,names_new_each)
-#%%
-#for name_new in names_new_each:
-#    fnames_new_each.append(cse.utilities.save_memmap_join(name_new, n_chunks=2, dview=None))
+    base_name=os.path.join(os.path.split(movie_names_hdf5[0])[0],'Yr')
+    fname_new=cb.save_memmap(movie_names_hdf5,base_name=base_name,idx_xy=idx_xy,resize_fact=(1,1,1),remove_init=0,dview=dview)
+    fnames_new_each.append(fname_new)
+    print fname_new
     
 
 #%%
@@ -1,7 +1,7 @@
 import traces,movies,timeseries,utils, rois, behavior, granule_cells.utils_granule
-from movies import movie,load,load_movie_chain,to_3D
+from movies import movie,lazy_movie,load,load_movie_chain,movie_info,iter_avi,save_memmap,load_memmap,map_chunks,to_3D,motion_correct_file,motion_correct_channels,online_registration,quality_metrics
 from traces import trace
-from timeseries import concatenate
+from timeseries import concatenate,save_tif
 from utils import matrixMontage,playMatrix,motion_correct_parallel
 from rois import extractROIsFromPCAICA
 
@@ -44,14 +44,14 @@ def select_roi(img,n_rois=1):
         
     return masks
 #%%
-def compute_optical_flow(m,mask,polar_coord=True,do_show=False,do_write=False,file_name=None,frate=30,pyr_scale=.1,levels=3 , winsize=25,iterations=3,poly_n=7,poly_sigma=1.5):
+def compute_optical_flow(m,mask,polar_coord=True,do_show=False,do_write=False,file_name=None,frate=30,pyr_scale=.1,levels=3 , winsize=25,iterations=3,poly_n=7,poly_sigma=1.5,out=None,chunk_frames=100,prefetch=1):
     """
     This function compute the optical flow of behavioral movies using the opencv cv2.calcOpticalFlowFarneback function 
         
     Parameters
     ----------
-    m: 3D ndarray:
-        input movie
+    m: 3D ndarray or calblitz.lazy_movie:
+        input movie, read chunk_frames frames at a time (a lazy_movie is read by a background thread while the flow is computed)
     mask: 2D ndarray
         mask selecting relevant pixels       
     polar_coord: boolean
@@ -62,6 +62,12 @@ def compute_optical_flow(m,mask,polar_coord=True,do_show=False,do_write=False,fi
         save flow movie
     frate: double
         frame rate saved movie
+    out: 4D ndarray or np.memmap (2,T,d1,d2)
+        preallocated output (e.g. np.lib.format.open_memmap), if None it is allocated in memory
+    chunk_frames: int
+        number of frames processed at a time
+    prefetch: int
+        number of chunks read ahead (see calblitz.movies.map_chunks)
         
     parameters_opencv_function: cv2.calcOpticalFlowFarneback
         pyr_scale,levels,winsize,iterations,poly_n,poly_sigma
@@ -70,7 +76,7 @@ def compute_optical_flow(m,mask,polar_coord=True,do_show=False,do_write=False,fi
 
     Returns
     --------
-    mov_tot: 4D ndarray containing the movies of the two coordinates
+    mov_tot: 4D ndarray containing the movies of the two coordinates (out if given)
     
 
     """        
@@ -86,55 +92,69 @@ def compute_optical_flow(m,mask,polar_coord=True,do_show=False,do_write=False,fi
     
     data = np.zeros(np.shape(m[0]), dtype=np.int32)
     T,d1,d2=m.shape
-    angs=np.zeros(T)
-    mags=np.zeros(T)
-    mov_tot=np.zeros([2,T,d1,d2])
+    if out is None:
+        out=np.zeros([2,T,d1,d2])
     
     if do_write:
-        if file_names is not None:
+        if file_name is not None:
            video = cv2.VideoWriter(file_name,cv2.VideoWriter_fourcc('M','J','P','G'),30,(d2*2,d1),1)
         else:
             raise Exception('You need to provide file name (.avi) when saving video')
             
-               
-    
-    for counter,next_ in enumerate(m):
-        print counter          
-        frame2 = cv2.cvtColor(np.uint8(next_), cv2.COLOR_GRAY2RGB)    
-        flow = cv2.calcOpticalFlowFarneback(prvs,next_, None, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, 0)    
-        
-        if polar_coord:    
-            coord_1, coord_2 = cv2.cartToPolar(flow[...,0], flow[...,1])
-        else:
-            coord_1, coord_2 = flow[:,:,0],flow[:,:,1]        
-        
-        coord_1*=data
-        coord_2*=data    
+    # state carried from one chunk to the next
+    state={'prvs':prvs,'counter':0,'show':do_show}
+    
+    def flow_chunk(chunk):
+        res=np.zeros((len(chunk),2,d1,d2))
+        for idx,next_ in enumerate(chunk):
+            print state['counter']          
+            frame2 = cv2.cvtColor(np.uint8(next_), cv2.COLOR_GRAY2RGB)    
+            flow = cv2.calcOpticalFlowFarneback(state['prvs'],next_, None, pyr_scale, levels, winsize, iterations, poly_n, poly_sigma, 0)    
             
-        if do_show or do_write:
-            if polar_coord:
-                hsv[...,0] = coord_2*180/np.pi/2
+            if polar_coord:    
+                coord_1, coord_2 = cv2.cartToPolar(flow[...,0], flow[...,1])
             else:
-                hsv[...,0] = cv2.normalize(coord_2,None,0,255,cv2.NORM_MINMAX)    
+                coord_1, coord_2 = flow[:,:,0],flow[:,:,1]        
+            
+            coord_1*=data
+            coord_2*=data    
                 
-            hsv[...,2] = cv2.normalize(coord_1,None,0,255,cv2.NORM_MINMAX)    
-            rgb = cv2.cvtColor(hsv,cv2.COLOR_HSV2BGR)    
-            frame_tot=np.concatenate([rgb,frame2],axis=1)
+            if state['show'] or do_write:
+                if polar_coord:
+                    hsv[...,0] = coord_2*180/np.pi/2
+                else:
+                    hsv[...,0] = cv2.normalize(coord_2,None,0,255,cv2.NORM_MINMAX)    
+                    
+                hsv[...,2] = cv2.normalize(coord_1,None,0,255,cv2.NORM_MINMAX)    
+                rgb = cv2.cvtColor(hsv,cv2.COLOR_HSV2BGR)    
+                frame_tot=np.concatenate([rgb,frame2],axis=1)
+                
+            if do_write:
+                video.write(frame_tot)
             
-        if do_write:
-            video.write(frame_tot)
+            if state['show']:
+                cv2.imshow('frame2',frame_tot)
+                k = cv2.waitKey(30) & 0xff
+                if k == 27:
+                    # stop showing, the flow of the remaining frames is still computed
+                    state['show']=False
+                    cv2.destroyAllWindows()
         
-        if do_show:
-            cv2.imshow('frame2',frame_tot)
-            k = cv2.waitKey(30) & 0xff
-            if k == 27:
-                break
-    
+            res[idx,0]=coord_1
+            res[idx,1]=coord_2
         
-        mov_tot[0,counter]=coord_1
-        mov_tot[1,counter]=coord_2
+            state['prvs'] = next_
+            state['counter'] += 1
+            
+        return res
+    
+    if hasattr(m,'iter_chunks'):
+        chunks=m.iter_chunks(chunk_frames,prefetch=prefetch)
+    else:
+        chunks=(m[idx:idx+chunk_frames] for idx in range(0,T,chunk_frames))
     
-        prvs = next_
+    # frames are written along the second axis of out
+    cb.movies.map_chunks(flow_chunk,chunks,out=out.transpose(1,0,2,3))
     
     if do_write:
         video.release()
@@ -142,7 +162,7 @@ def compute_optical_flow(m,mask,polar_coord=True,do_show=False,do_write=False,fi
     if do_show:
         cv2.destroyAllWindows()
     
-    return mov_tot
+    return out
 
 
 
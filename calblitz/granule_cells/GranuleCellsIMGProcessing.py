@@ -115,28 +115,11 @@ file_res=cb.motion_correct_parallel(fnames,fr=30,template=None,margins_out=0,max
 t2=time()-t1
 print t2  
 
-#%%   
-all_movs=[]
-for f in  fnames:
-    print f
-    with np.load(f[:-3]+'npz') as fl:
-#        pl.subplot(1,2,1)
-#        pl.imshow(fl['template'],cmap=pl.cm.gray)
-#        pl.subplot(1,2,2)
-#        pl.plot(fl['shifts'])       
-        all_movs.append(fl['template'][np.newaxis,:,:])
-#        pl.pause(.1)
-#        pl.cla()
-#%%        
-all_movs=cb.movie(np.concatenate(all_movs,axis=0),fr=10)
-all_movs,shifts,corss,_=all_movs.motion_correct(template=all_movs[1],max_shift_w=45, max_shift_h=45)
-#%%
-template=np.median(all_movs[:],axis=0)
+#%%
+template=cb.utils.build_global_template(file_res,fr=10,max_shift_w=45, max_shift_h=45,dview=client_[::2])
 np.save(base_folder+'template_total',template)
 pl.imshow(template,cmap=pl.cm.gray,vmax=120)
 #%%
-all_movs.play(backend='opencv',gain=5,fr=30)
-#%%
 t1 = time()
 file_res=cb.motion_correct_parallel(fnames,30,template=template,margins_out=0,max_shift_w=45, max_shift_h=45,dview=client_[::2],remove_blanks=False)
 t2=time()-t1
@@ -83,7 +83,7 @@ for base_folder in base_folders:
     print fls 
     # verufy they are ordered 
     #%%
-    triggers_img,trigger_names_img=gc.extract_triggers(fls,read_dictionaries=False)     
+    triggers_img,trigger_names_img=gc.extract_triggers_batch(fls)     
     np.savez(base_folder+'all_triggers.npz',triggers=triggers_img,trigger_names=trigger_names_img)   
     #%% get information from eyelid traces
     t_start=time()     
@@ -115,10 +115,75 @@ def extract_triggers(file_list,read_dictionaries=False):
         
     return triggers,trigger_names
 
+#%%
+def extract_triggers_batch(file_list,use_cache=True,dview=None):
+    """Extract the triggers of all the trials of a day at once (see extract_triggers)
 
+    Only the I2CData and frameNumberAcquisition fields of the image descriptions are read. They are cached
+    next to each tif file and invalidated by its modification time (see calblitz.utils.get_image_description_columns_SI),
+    so adding a trial file to a folder only scans that file
 
+    Parameters
+    -----------
+    file_list: list of tif files, or folder (all its tif files, sorted by name)
+    use_cache: whether to read and write the header cache of the files
+    dview: ipyparallel view, if not None the files are scanned by its engines
+
+    Returns
+    -------
+    triggers: np.array (n_trials x 4)
+        [idx_CS, idx_US, trial_type, number_of_frames]. Trial types: 0 CS alone, 1 US alone, 2 CS US
+
+    trigger_names: list
+        file name associated (without extension)
+    """
+    if type(file_list) is str:
+        file_list=glob(os.path.join(file_list,'*.tif'))
+        file_list.sort()
+
+    args=[(fl,use_cache) for fl in file_list]
+    if dview is not None:
+        triggers=dview.map_sync(trial_triggers,args)
+    else:
+        triggers=map(trial_triggers,args)
+
+    return np.array(triggers).reshape((-1,4)),[fl[:-4] for fl in file_list]
+
+def trial_triggers(arg_in):
+    """[idx_CS, idx_US, trial_type, number_of_frames] of one trial file (see extract_triggers_batch)
+
+    Parameters
+    -----------
+    arg_in: tuple (file_name, use_cache)
+    """
+    import calblitz as cb
+    fl,use_cache=arg_in
+    columns=cb.utils.get_image_description_columns_SI([fl],keys=('I2CData','frameNumberAcquisition'),use_cache=use_cache)[0]
+    i2cd=columns['I2CData']
+    frame_numbers=columns['frameNumberAcquisition']
+
+    is_str=np.array([isinstance(i,basestring) for i in i2cd],dtype=bool)
+    trig_vect=np.zeros(4)*np.nan
+    for idx_trig,trig in [(0,'CS_ON'),(1,'US_ON')]:
+        found=np.where(is_str)[0]
+        found=found[np.char.find(i2cd[found].astype(str),trig)>=0]
+        if len(found):
+            # as in extract_triggers, the last page carrying the trigger
+            trig_vect[idx_trig]=frame_numbers[found[-1]]-1
+
+    if np.nansum(trig_vect>0)==2:
+        trig_vect[2]=2
+    elif trig_vect[0]>0:
+        trig_vect[2]=0
+    elif trig_vect[1]>0:
+        trig_vect[2]=1
+    else:
+        raise Exception('No triggers present in trial '+fl)
+
+    trig_vect[3]=len(i2cd)
+
+    return trig_vect
 
-    
 #%%
 def downsample_triggers(triggers,fraction_downsample=1):
     """ downample triggers so as to make them in line with the movies
@@ -132,6 +197,7 @@ def downsample_triggers(triggers,fraction_downsample=1):
         fraction the data is shrinked in the time axis
     """
     
+    triggers=np.array(triggers,dtype=np.float)
     triggers[:,[0,1,3]]=np.round(triggers[:,[0,1,3]]*fraction_downsample)
 #    triggers[-1,[0,1,3]]=np.floor(triggers[-1,[0,1,3]]*fraction_downsample)
 #    triggers[-1]=np.cumsum(triggers[-1])
@@ -1065,6 +1131,17 @@ def load_data_from_stored_results(base_folder, load_masks=False, thresh_CR = 0.1
     return traces, masks, triggers_out, amplitudes, ISI 
     
 #%%
+def load_day_manifest(base_folder):
+    """
+    Manifest of the movies of a day (see calblitz.utils.update_manifest), that must be built or updated
+    with cb.utils.update_manifest(base_folder) after the movies and their shifts are saved. Reading it
+    does not touch the movies
+    """
+    manifest=cb.utils.load_manifest(base_folder)
+    if not manifest:
+        raise IOError('No manifest in '+base_folder+', run cb.utils.update_manifest first')
+    return manifest
+#%%
 def fast_process_day(base_folder,min_radius=3,max_radius=4):
     import pickle
     import pylab as pl
@@ -1078,6 +1155,7 @@ def fast_process_day(base_folder,min_radius=3,max_radius=4):
         f_results= glob(base_folder+'*results_analysis.npz')
         f_results.sort()
         A_s,C_s, YrA_s, Cn_s, b_s, f_s, shape =  load_results(f_results)     
+        manifest=load_day_manifest(base_folder)
     #    B_s, lab_imgs, cm_s  = threshold_components(A_s,shape, min_size=10,max_size=50,max_perc=.5)
         traces=[]
         traces_BL=[]
@@ -1092,9 +1170,9 @@ def fast_process_day(base_folder,min_radius=3,max_radius=4):
             chunk_sizes=[]
             for mv in mov_names:
                     base_name=os.path.splitext(os.path.split(mv)[-1])[0]
-                    with np.load(base_folder+base_name+'.npz') as ld:
-                        TT=len(ld['shifts'])            
-                    chunk_sizes.append(TT)
+                    if base_name not in manifest or manifest[base_name]['n_shifts'] is None:
+                        raise IOError('No shifts for '+base_folder+base_name+'.npz in the manifest, run cb.utils.update_manifest')
+                    chunk_sizes.append(manifest[base_name]['n_shifts'])
         
             
             masks_ws,pos_examples,neg_examples=cse.utilities.extract_binary_masks_blob(A, min_radius, \
@@ -1162,9 +1240,13 @@ def process_fast_process_day(base_folders,save_name='temp_save.npz'):
                 template_each=ld['template_each']
             
             
+            manifest=load_day_manifest(base_folder)
             idx_chunks=[] 
             for name_chunk in movie_names:
-                idx_chunks.append([np.int(re.search('_00[0-9][0-9][0-9]_0',nm).group(0)[2:6])-1 for nm in name_chunk])
+                trials=[manifest.get(os.path.splitext(os.path.split(nm)[-1])[0],{}).get('trial') for nm in name_chunk]
+                if None in trials:
+                    raise IOError('Trial index of '+name_chunk[trials.index(None)]+' not in the manifest, run cb.utils.update_manifest')
+                idx_chunks.append(trials)
               
             
             
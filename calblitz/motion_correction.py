@@ -5,131 +5,179 @@ Created on Fri Mar  4 21:02:12 2016
 @author: agiovann, adapted from motion correction algorithm from Selmaan Chettih
 """
 #%%
-import calblitz as cb
 import numpy as np
-import pylab as pl
+import cv2
 #%%
-import scipy
-chone=cb.load('/Users/agiovann/Documents/MATLAB/Motion_Correction/M_FLUO_1.tif',fr=15)
-chone=chone[:,8:-8,8:-8]
-T=np.median(chone,axis=0)
-Nbasis = 8
-minIters = 5
+def bspline_basis(n_rows, n_basis=16):
+    """
+    Linear b-splines with n_basis+1 knots evenly spaced along the rows of the frame
 
-#linear b-splines
-knots = np.linspace(1,np.shape(T)[0],Nbasis+1);
-knots = np.hstack([knots[0]-(knots[1]-knots[0]),knots,knots[-1]+(knots[-1]-knots[-2])]);
+    Parameters
+    ----------
+    n_rows: int
+        number of rows of the frame
+    n_basis: int
+        number of intervals between knots
 
-weights=knots[:-2]
-order=len(knots)-len(weights)-1
+    Returns
+    -------
+    B: ndarray (n_rows, n_basis+1)
+        value of each basis function on each row
+    allBs: ndarray (n_rows, 2*n_basis+1)
+        squares of the basis functions followed by the products of neighbouring ones,
+        used to assemble the tridiagonal hessian
+    """
+    knots = np.linspace(0, n_rows - 1, n_basis + 1)
+    B = np.maximum(0, 1 - np.abs(np.arange(n_rows)[:, None] - knots[None, :]) / (knots[1] - knots[0]))
+    Bi = B[:, :-1] * B[:, 1:]
+    allBs = np.concatenate([B**2, Bi], axis=1)
+    return B, allBs
 
-x=range(T.shape[0])
-
-B = np.zeros((len(x),len(weights)))
-for ii in range(len(knots)-order-1):
-    B[:,ii] = bin(this.knots,ii,this.order,x);
-end
+#%%
+def solve_tridiagonal(lower, diag, upper, rhs):
+    """
+    Solve a batch of tridiagonal systems with the Thomas algorithm, vectorized over the leading axes
 
-spl = fastBSpline(knots,knots(1:end-2))
+    Parameters
+    ----------
+    lower, upper: ndarray (..., n-1)
+        sub and super diagonals
+    diag: ndarray (..., n)
+        diagonal
+    rhs: ndarray (..., n)
+        right hand side
 
+    Returns
+    -------
+    x: ndarray (..., n)
+    """
+    n = diag.shape[-1]
+    c = np.zeros(upper.shape)
+    d = np.zeros(rhs.shape)
+    denom = diag[..., 0]
+    d[..., 0] = rhs[..., 0] / denom
+    for i in range(1, n):
+        c[..., i - 1] = upper[..., i - 1] / denom
+        denom = diag[..., i] - lower[..., i - 1] * c[..., i - 1]
+        d[..., i] = (rhs[..., i] - lower[..., i - 1] * d[..., i - 1]) / denom
 
-B = spl.getBasis((1:size(T,1))');
-Tnorm = T(:)-mean(T(:));
-Tnorm = Tnorm/sqrt(sum(Tnorm.^2));
-B = full(B);
+    for i in range(n - 2, -1, -1):
+        d[..., i] -= c[..., i] * d[..., i + 1]
 
-lambda = .0001*median(T(:))^2;
-theI = (eye(Nbasis+1)*lambda);
+    return d
 
-Bi = B(:,1:end-1).*B(:,2:end);
-allBs = [B.^2,Bi];
-[xi,yi] = meshgrid(1:size(T,2),1:size(T,1)); 
+#%%
+def mycorr(A, Tnorm):
+    """
+    Correlation of each frame of A with the normalized template Tnorm, (A: ndarray (n, h, w))
+    """
+    A = A.reshape((A.shape[0], -1))
+    A = A - np.mean(A, axis=1)[:, None]
+    return A.dot(Tnorm.ravel()) / np.sqrt(np.sum(A**2, axis=1))
 
 #%%
-def doLucasKanade_singleFrame(T, I, B, allBs, xi, yi, theI, Tnorm, nBasis=4, minIters=5):
+def lucas_kanade_frames(T, I, n_basis=16, dpx=None, dpy=None, max_iters=25, min_iters=5,
+                        deltacorr=0.0005, damping=1, B=None, allBs=None):
+    """
+    Line by line b-spline Lucas Kanade registration of a batch of frames (Chettih algorithm).
+    Every row of a frame is displaced along x and y by the linear b-spline interpolation of
+    the displacements at the knots, which is optimized with Gauss-Newton iterations.
+    The hessians are tridiagonal, they are assembled from allBs and solved
+    for all the frames of the batch at once.
+
+    Parameters
+    ----------
+    T: ndarray (h, w)
+        template
+    I: ndarray (n, h, w)
+        frames to register
+    n_basis: int
+        number of intervals between the knots of the b-splines
+    dpx, dpy: ndarray (n, n_basis+1)
+        initial displacements at the knots along width and height (zeros if None)
+    max_iters, min_iters: int
+        maximum number of iterations and number of iterations before checking convergence
+    deltacorr: float
+        a frame is converged when its correlation with the template improves less than this
+    damping: float
+        fraction of the Gauss-Newton step applied at each iteration
+    B, allBs: precomputed output of bspline_basis
+
+    Returns
+    -------
+    Id: ndarray (n, h, w)
+        registered frames
+    dpx, dpy: ndarray (n, n_basis+1)
+        displacements at the knots
+    corrs: ndarray (n,)
+        correlation of each registered frame with the template
+    n_iters: ndarray (n,)
+        number of iterations performed for each frame
+    """
+    n, h, w = I.shape
+    if B is None or allBs is None:
+        B, allBs = bspline_basis(h, n_basis)
+    nb = B.shape[1]
+
+    dpx = np.zeros((n, nb)) if dpx is None else np.array(dpx, dtype=np.float64)
+    dpy = np.zeros((n, nb)) if dpy is None else np.array(dpy, dtype=np.float64)
+
+    Tnorm = T - np.mean(T)
+    Tnorm = Tnorm / np.sqrt(np.sum(Tnorm**2))
+    lambda_ = .0001 * np.median(T)**2
+
+    xi, yi = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+    bl = np.percentile(I.reshape((n, -1)), 1, axis=1)
+
+    Id = np.empty((n, h, w), dtype=np.float32)
+    c0 = mycorr(I, Tnorm)
+    corrs = c0.copy()
+    n_iters = np.zeros(n, dtype=np.int)
+    active = np.arange(n)
+
+    for ii in range(max_iters):
+        # displaced frames
+        Dx = B.dot(dpx[active].T).T.astype(np.float32)
+        Dy = B.dot(dpy[active].T).T.astype(np.float32)
+        for k, idx in enumerate(active):
+            Id[idx] = cv2.remap(I[idx], xi + Dx[k][:, None], yi + Dy[k][:, None], cv2.INTER_LINEAR,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=float(bl[idx]))
 
-    maxIters = 50
-    deltacorr = 0.0005
-    
-    _ , w = np.shape(T)
-    
-    #Find optimal image warp via Lucas Kanade    
-    c0 = mycorr(I(:), Tnorm);
-    
-    for ii = 1:maxIters
-#        %Displaced template
-#        Dx = repmat((B*dpx), 1, w);
-#        Dy = repmat((B*dpy), 1, w);
-        
-        Id = interp2(I, xi, yi, 'linear', 0);
-                
-        %gradient
-        [dTx, dTy] = imgradientxy(Id, 'centraldifference');
-        dTx(:, [1, ]) = 0;
-        dTy([1, ], :) = 0;
-        
-        if ii > minIters
-            c = mycorr(Id(:), Tnorm);
-            if c - c0 < deltacorr && ii > 1
-                break;
-            
-            c0 = c;
-        
- 
-        del = T - Id;
- 
-        %special trick for g (easy)
-        gx = B'*sum(del.*dTx, 2);
-        gy = B'*sum(del.*dTy, 2);
- 
-        %special trick for H - harder
-        Hx = constructH(allBs'*sum(dTx.^2,2), nBasis+1) + theI;
-        Hy = constructH(allBs'*sum(dTy.^2,2), nBasis+1) + theI;
- 
-        dpx = Hx\gx;
-        dpy = Hy\gy;
-        
-    return [Id, dpx, dpy]
+        n_iters[active] += 1
+        c = mycorr(Id[active], Tnorm)
+        corrs[active] = c
+        if ii >= min_iters:
+            keep = (c - c0[active]) >= deltacorr
+            active = active[keep]
+            c = c[keep]
+            if len(active) == 0:
+                break
+        c0[active] = c
 
-#         dpx = dpx + damping*dpx_;
-#         dpy = dpy + damping*dpy_;
-    
+        if ii == max_iters - 1:
+            break
 
+        Ida = Id[active]
+        # gradient
+        dTx = np.zeros(Ida.shape, dtype=np.float32)
+        dTy = np.zeros(Ida.shape, dtype=np.float32)
+        dTx[:, :, 1:-1] = (Ida[:, :, 2:] - Ida[:, :, :-2]) / 2
+        dTy[:, 1:-1, :] = (Ida[:, 2:, :] - Ida[:, :-2, :]) / 2
 
-function thec = mycorr(A,B)
-    meanA = mean(A(:));
-    A = A(:) - meanA;
-    A = A / sqrt(sum(A.^2));
-    thec = A'*B;
+        del_ = T[None, :, :] - Ida
 
- 
-function H2 = constructH(Hd,ns)
-%     H2d1 = Hd(1:ns)';
-%     H2d2 = [Hd(ns+1:);0]';
-%     H2d3 = [0;Hd(ns+1:)]';
-%     
-%     if isa(Hd, 'gpuArray')
-%         H2 = gpuArray.zeros(ns);
-%     else
-%         H2 = zeros(ns);
-%     
-%             
-%     H2((0:ns-1)*ns+(1:ns)) = H2d1;
-%     H2(((1:ns-1)*ns+(1:ns-1))) = H2d2(1:-1);
-%     H2(((0:ns-2)*ns+(1:ns-1))+1) = H2d3(2:);
+        # special trick for g (easy)
+        gx = np.sum(del_ * dTx, axis=2).dot(B)
+        gy = np.sum(del_ * dTy, axis=2).dot(B)
 
-    if isa(Hd, 'gpuArray')
-        H2 = gpuArray.zeros(ns);
-    else
-        H2 = zeros(ns);
-    
-            
-    H2((0:ns-1)*ns+(1:ns)) = Hd(1:ns)';
-    H2(((1:ns-1)*ns+(1:ns-1))) = Hd(ns+1:)';
-    H2(((0:ns-2)*ns+(1:ns-1))+1) = Hd(ns+1:)';
+        # special trick for H - harder
+        Hx = np.sum(dTx**2, axis=2).dot(allBs)
+        Hy = np.sum(dTy**2, axis=2).dot(allBs)
 
+        dpx[active] += damping * solve_tridiagonal(Hx[:, nb:], Hx[:, :nb] + lambda_, Hx[:, nb:], gx)
+        dpy[active] += damping * solve_tridiagonal(Hy[:, nb:], Hy[:, :nb] + lambda_, Hy[:, nb:], gy)
 
- 
+    return Id, dpx, dpy, corrs, n_iters
 
 #%%
 ####
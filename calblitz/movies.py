@@ -8,6 +8,7 @@ Updated on Fri Aug 19 17:30:11 2016
 
 import cv2
 import os
+import time
 import sys
 import scipy.ndimage
 import scipy
@@ -21,11 +22,12 @@ from sklearn.metrics.pairwise import euclidean_distances
 import pylab as plt
 import h5py
 import cPickle as cpk
-from scipy.io import loadmat
+from scipy.io import loadmat, whosmat
 from matplotlib import animation
 import pylab as pl
-from skimage.external.tifffile import imread
+from skimage.external.tifffile import imread, TiffFile
 from tqdm import tqdm
+from multiprocessing.pool import ThreadPool
 
 # from ca_source_extraction.utilities import save_memmap,load_memmap
 
@@ -41,7 +43,8 @@ from skimage import data
 
 import timeseries as ts
 from traces import trace
-from utils import display_animation
+from utils import display_animation, load_shifts_cache, save_shifts_cache, frames_digest
+import motion_correction as mc
 
 
 class movie(ts.timeseries):
@@ -71,7 +74,7 @@ class movie(ts.timeseries):
     #             file_name=None, meta_data=None, **kwargs):
     def __new__(cls, input_arr, **kwargs):
 
-        if (type(input_arr) is np.ndarray) or \
+        if isinstance(input_arr, np.ndarray) or \
            (type(input_arr) is h5py._hl.dataset.Dataset):
             # kwargs['start_time']=start_time;
             # kwargs['file_name']=file_name;
@@ -88,7 +91,18 @@ class movie(ts.timeseries):
                        num_frames_template=None,
                        template=None,
                        method='opencv',
-                       remove_blanks=False):
+                       remove_blanks=False,
+                       n_threads=1,
+                       pyramid_levels=0,
+                       use_cache=False,
+                       cache_dir=None,
+                       cache_params=None,
+                       warp_mode='affine',
+                       ecc_iters=100,
+                       ecc_eps=1e-5,
+                       template_iters=None,
+                       template_tol=1e-3,
+                       return_metrics=False):
 
         '''
         Extract shifts and motion corrected movie automatically,
@@ -102,9 +116,36 @@ class movie(ts.timeseries):
         template: if a good template for frame by frame correlation exists
                   it can be passed. If None it is automatically computed
         method: depends on what is installed 'opencv' or 'skimage'. 'skimage'
-                is an order of magnitude slower
+                is an order of magnitude slower. 'fft' extracts the shifts with
+                the batched FFT engine and applies them with opencv. 'ecc' refines the
+                rigid registration of each frame with cv2.findTransformECC (see register_ecc),
+                the returned shifts are then the warp matrices of the frames, (T,2,3) (or
+                (T,3,3) for homography), instead of the (T,2) offsets of the other methods
         num_frames_template: if only a subset of the movies needs to be loaded
                              for efficiency/speed reasons
+        n_threads: number of threads used to extract and apply the shifts
+        pyramid_levels: coarse to fine search for large shifts (see extract_shifts)
+        use_cache: if True shifts, xcorrs and template are looked up in the shift cache
+                   (see utils.load_shifts_cache) with a key made of the file the movie was loaded
+                   from, its shape, a digest of a sample of its frames (so that different subindices
+                   or crops of the same file have different keys) and the registration parameters. If found, only apply_shifts runs,
+                   otherwise the computed shifts are stored in the cache
+        cache_dir: folder of the shift cache, if None the folder shifts_cache next to the file
+        cache_params: dict, additional values identifying how the movie was processed after
+                      loading (e.g. smoothing), they are part of the cache key
+        warp_mode,ecc_iters,ecc_eps: motion model and termination criteria when method is 'ecc'
+                                     (see register_ecc)
+        template_iters: if None the template is refined registering the subsample and then a copy of
+                        the whole movie. Otherwise the subsample is registered to the template and the
+                        template recomputed up to template_iters times, and the whole movie is registered once
+        template_tol: the refinement stops when the norm of the change of the template relative
+                      to its norm is below template_tol
+        return_metrics: if True also return a dict of quality metrics of the registration, computed
+                        while registering: correlation of each frame with the template at the estimated
+                        shift ('corr', None if the shifts come from the cache), mean and variance images
+                        of the corrected movie and crispness of the mean image (see quality_metrics).
+                        With method 'ecc', 'ecc' is the per frame record of register_ecc (cc, failed,
+                        converged and time of each frame), None otherwise
 
 
         Returns
@@ -113,14 +154,42 @@ class movie(ts.timeseries):
         shifts : tuple, contains x & y shifts and correlation with template
         xcorrs: cross correlation of the movies with the template
         template= the computed template
+        metrics: (only if return_metrics) dict of quality metrics
         '''
 
+        cached = None
+        if use_cache:
+            key_params = dict(ref_template=template, max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                              num_frames_template=num_frames_template, method=method,
+                              pyramid_levels=pyramid_levels, shape=self.shape,
+                              template_iters=template_iters, template_tol=template_tol,
+                              frames=frames_digest(self))
+            key_params.update(cache_params or {})
+            if self.file_name is None or self.file_name[0] is None:
+                warnings.warn('The movie is not associated to a file, the shift cache is not used')
+                use_cache = False
+            else:
+                cached = load_shifts_cache(self.file_name[0], cache_dir=cache_dir, **key_params)
+
         # adjust the movie so that valuse are non negative
 
         min_val = np.min(np.mean(self, axis=0))
         self = self-min_val
 
-        if template is None:  # if template is not provided it is created
+        # the fft engine only estimates shifts, they are applied with opencv
+        apply_method = 'opencv' if method in ('fft', 'ecc') else method
+        # ecc starts from the rigid shifts estimated with opencv
+        if method == 'ecc':
+            method = 'opencv'
+            use_ecc = True
+        else:
+            use_ecc = False
+
+        if cached is not None:
+            print 'Using cached shifts'
+            shifts, xcorrs, template = cached
+
+        elif template is None:  # if template is not provided it is created
             if num_frames_template is None:
                 num_frames_template = 10e7/(512*512)
 
@@ -132,30 +201,120 @@ class movie(ts.timeseries):
 
             submov = self[::frames_to_skip, :].copy()
             templ = submov.bin_median() # create template with portion of movie
-            shifts,xcorrs=submov.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=templ, method=method)  #
-            submov.apply_shifts(shifts,interpolation='cubic',method=method)
-            template=submov.bin_median()
-            del submov
-            m=self.copy()
-            shifts,xcorrs=m.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=template, method=method)  #
-            m=m.apply_shifts(shifts,interpolation='cubic',method=method)
-            template=(m.bin_median())
-            del m
-
-        # now use the good template to correct
-        shifts,xcorrs=self.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=template, method=method)  #
-        self=self.apply_shifts(shifts,interpolation='cubic',method=method)
+
+            if template_iters is not None:
+                # refine the template on the subsample only
+                for it in range(template_iters):
+                    m = submov.copy()
+                    shifts,xcorrs=m.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=templ, method=method, n_threads=n_threads, pyramid_levels=pyramid_levels)  #
+                    m=m.apply_shifts(shifts,interpolation='cubic',method=apply_method,n_threads=n_threads)
+                    new_templ = m.bin_median()
+                    del m
+                    change = np.linalg.norm(new_templ - templ)/np.linalg.norm(templ)
+                    templ = new_templ
+                    print 'Template iteration %d, relative change %.2e' % (it+1, change)
+                    if change < template_tol:
+                        break
+                template = templ
+                del submov
+            else:
+                shifts,xcorrs=submov.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=templ, method=method, n_threads=n_threads, pyramid_levels=pyramid_levels)  #
+                submov.apply_shifts(shifts,interpolation='cubic',method=apply_method,n_threads=n_threads)
+                template=submov.bin_median()
+                del submov
+                m=self.copy()
+                shifts,xcorrs=m.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=template, method=method, n_threads=n_threads, pyramid_levels=pyramid_levels)  #
+                m=m.apply_shifts(shifts,interpolation='cubic',method=apply_method,n_threads=n_threads)
+                template=(m.bin_median())
+                del m
+
+        corr = None
+        if cached is None:
+            # now use the good template to correct
+            shifts,xcorrs,corr_metrics=self.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=template, method=method, n_threads=n_threads, pyramid_levels=pyramid_levels, return_metrics=True)  #
+            corr = corr_metrics['corr']
+            if use_cache:
+                save_shifts_cache(self.file_name[0], shifts, xcorrs, template, cache_dir=cache_dir, **key_params)
+
+        rigid_shifts = shifts
+        ecc_info = None
+        if use_ecc:
+            self,shifts,xcorrs,ecc_info=self.register_ecc(template,shifts=shifts,warp_mode=warp_mode,max_iters=ecc_iters,eps=ecc_eps,n_threads=n_threads)
+            if not np.all(ecc_info['converged']):
+                warnings.warn('ECC did not converge for %d/%d frames (%d failed, see ecc in the metrics, return_metrics=True)' % (np.sum(~ecc_info['converged']), len(ecc_info), np.sum(ecc_info['failed'])))
+        else:
+            self=self.apply_shifts(shifts,interpolation='cubic',method=apply_method,n_threads=n_threads)
         self=self+min_val
 
+        if return_metrics:
+            metrics = quality_metrics(*_frame_moments(self, n_threads))
+            metrics['corr'] = corr
+            metrics['ecc'] = ecc_info
+
         if remove_blanks:
-            max_h,max_w= np.max(shifts,axis=0)
-            min_h,min_w= np.min(shifts,axis=0)
+            max_h,max_w= np.max(rigid_shifts,axis=0)
+            min_h,min_w= np.min(rigid_shifts,axis=0)
             self=self.crop(crop_top=max_h,crop_bottom=-min_h+1,crop_left=max_w,crop_right=-min_w,crop_begin=0,crop_end=0)
 
+        if return_metrics:
+            return self,shifts,xcorrs,template,metrics
 
         return self,shifts,xcorrs,template
 
 
+    def motion_correct_online(self, max_shift_w=5, max_shift_h=5, template=None, chunk_frames=100,
+                              update='mean', alpha=0.01, method='opencv', interpolation='cubic', n_threads=1):
+        """
+        Motion correct the frames in temporal order against a template that follows slow changes
+        of the preparation (drift, bleaching). Chunks of frames are registered to the current template,
+        which is then updated with the registered frames (see online_registration). Disclaimer, it might
+        change the object itself.
+
+        Parameters
+        ----------
+        max_shift_w,max_shift_h: maximum pixel shifts allowed when correcting in the width and height direction
+        template: initial template. If None it is computed from the first chunk
+        chunk_frames: number of frames registered to the same template
+        update: 'mean' (exponential running mean) or 'median' (running median estimate)
+        alpha: weight of each new frame in the template
+        method, interpolation, n_threads: see extract_shifts and apply_shifts
+
+        Returns
+        -------
+        self: motion corrected movie
+        shifts: shifts in x and y for each frame
+        xcorrs: cross correlation of each frame with the template at the time it was registered
+        template: the template after the last frame
+        """
+        reg = online_registration(self.fr, max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=template,
+                                  update=update, alpha=alpha, method=method, interpolation=interpolation,
+                                  n_threads=n_threads)
+        if type(self[0, 0, 0]) is not np.float32:
+            warnings.warn('Casting the array to float 32')
+            self = np.asanyarray(self, dtype=np.float32)
+
+        shifts = []
+        xcorrs = []
+        for idx in range(0, self.shape[0], chunk_frames):
+            chunk, sh, xc = reg.register(self[idx:idx + chunk_frames])
+            self[idx:idx + chunk_frames] = chunk
+            shifts += sh
+            xcorrs += xc
+
+        return self, shifts, xcorrs, reg.template
+
+    def iter_chunks(self, chunk_frames=1000, prefetch=0):
+        """
+        Iterate over the movie chunk_frames frames at a time (the interface of lazy_movie.iter_chunks,
+        the movie is in memory so nothing is prefetched)
+
+        Returns
+        -------
+        generator of calblitz.movie (views of the movie)
+        """
+        for idx in range(0, self.shape[0], chunk_frames):
+            yield self[idx:idx + chunk_frames]
+
     def bin_median(self,window=10):
         T,d1,d2=np.shape(self)
         num_windows=np.int(T/window)
@@ -163,7 +322,7 @@ class movie(ts.timeseries):
         return np.median(np.mean(np.reshape(self[:num_frames],(window,num_windows,d1,d2)),axis=0),axis=0)
 
 
-    def extract_shifts(self, max_shift_w=5,max_shift_h=5, template=None, method='opencv'):
+    def extract_shifts(self, max_shift_w=5,max_shift_h=5, template=None, method='opencv', batch_size=50, n_threads=1, pyramid_levels=0, return_metrics=False):
         """
         Performs motion corretion using the opencv matchtemplate function. At every iteration a template is built by taking the median of all frames and then used to align the other frames.
 
@@ -171,12 +330,24 @@ class movie(ts.timeseries):
         ----------
         max_shift_w,max_shift_h: maximum pixel shifts allowed when correcting in the width and height direction
         template: if a good template for frame by frame correlation is available it can be passed. If None it is automatically computed
-        method: depends on what is installed 'opencv' or 'skimage'. 'skimage' is an order of magnitude slower
+        method: depends on what is installed 'opencv' or 'skimage'. 'skimage' is an order of magnitude slower.
+                'fft' registers blocks of frames at once with a batched FFT cross-correlation (same result as 'opencv')
+        batch_size: number of frames registered together when method is 'fft'
+        n_threads: number of threads among which contiguous chunks of frames are split
+        pyramid_levels: if larger than 0, the shifts are first estimated on frames downsampled
+                        pyramid_levels times by 2 and then refined at full resolution within
+                        +/- 2**pyramid_levels pixels. Useful for large maximum shifts, in which case
+                        xcorrs is the average over the refinement window only. Both levels match
+                        frames one by one with cv2.matchTemplate (or skimage if method is 'skimage'),
+                        so method='fft' and batch_size are ignored when pyramid_levels > 0
+        return_metrics: if True a dict of quality metrics is also returned, with the
+                        correlation of each frame with the template at the estimated shift ('corr')
 
         Returns
         -------
         shifts : tuple, contains shifts in x and y and correlation with template
         xcorrs: cross correlation of the movies with the template
+        metrics: (only if return_metrics) dict of quality metrics
         """
 
         if np.min(np.mean(self, axis=0)) < 0:
@@ -195,70 +366,77 @@ class movie(ts.timeseries):
         if template is None:
             template = np.median(self, axis=0)
 
+        template_full = np.asarray(template, dtype=np.float32)
         template=template[ms_h:h_i-ms_h,ms_w:w_i-ms_w].astype(np.float32)
         h, w = template.shape      # template width and height
 
+        if method not in ('opencv', 'skimage', 'fft'):
+            raise Exception('Unknown motion correction ethod!')
+
+        def match(frame, templ):
+            if method == 'skimage':
+                return match_template(frame, templ)
+            else:
+                return cv2.matchTemplate(frame, templ, cv2.TM_CCORR_NORMED)
+
+        if pyramid_levels > 0:
+            factor = 2 ** pyramid_levels
+            ms_h_c = int(np.ceil(ms_h * 1. / factor))
+            ms_w_c = int(np.ceil(ms_w * 1. / factor))
+            coarse_template = _pyr_down(template_full, pyramid_levels)
+            coarse_template = coarse_template[ms_h_c:coarse_template.shape[0] - ms_h_c,
+                                              ms_w_c:coarse_template.shape[1] - ms_w_c]
+        elif method == 'fft':
+            template_fft = _fft_template(template, (h_i, w_i))
 
         #% run algorithm, press q to stop it
-        shifts=[];   # store the amount of shift in each frame
-        xcorrs=[];
-
-        for i,frame in enumerate(self):
-             if i%100==99:
-                 print "Frame %i"%(i+1);
-             if method == 'opencv':
-                 res = cv2.matchTemplate(frame,template,cv2.TM_CCORR_NORMED)
-                 top_left = cv2.minMaxLoc(res)[3]
-             elif method == 'skimage':
-                 res = match_template(frame,template)
-                 top_left = np.unravel_index(np.argmax(res),res.shape);
-                 top_left=top_left[::-1]
-             else:
-                 raise Exception('Unknown motion correction ethod!')
-             avg_corr=np.mean(res);
-             sh_y,sh_x = top_left
-             bottom_right = (top_left[0] + w, top_left[1] + h)
-
-             if (0 < top_left[1] < 2 * ms_h-1) & (0 < top_left[0] < 2 * ms_w-1):
-                 # if max is internal, check for subpixel shift using gaussian
-                 # peak registration
-                 log_xm1_y = np.log(res[sh_x-1,sh_y]);
-                 log_xp1_y = np.log(res[sh_x+1,sh_y]);
-                 log_x_ym1 = np.log(res[sh_x,sh_y-1]);
-                 log_x_yp1 = np.log(res[sh_x,sh_y+1]);
-                 four_log_xy = 4*np.log(res[sh_x,sh_y]);
-
-                 sh_x_n = -(sh_x - ms_h + (log_xm1_y - log_xp1_y) / (2 * log_xm1_y - four_log_xy + 2 * log_xp1_y))
-                 sh_y_n = -(sh_y - ms_w + (log_x_ym1 - log_x_yp1) / (2 * log_x_ym1 - four_log_xy + 2 * log_x_yp1))
-             else:
-                 sh_x_n = -(sh_x - ms_h)
-                 sh_y_n = -(sh_y - ms_w)
-
-#             if not only_shifts:
-#                 if method == 'opencv':
-#                     M = np.float32([[1,0,sh_y_n],[0,1,sh_x_n]])
-#                     self[i] = cv2.warpAffine(frame,M,(w_i,h_i),flags=interpolation)
-#                 elif method == 'skimage':
-#                     tform = AffineTransform(translation=(-sh_y_n,-sh_x_n))
-#                     self[i] = warp(frame, tform,preserve_range=True,order=3)
-#                 if show_movie:
-#                 fr = cv2.resize(self[i],None,fx=2, fy=2, interpolation = cv2.INTER_CUBIC)
-#                 cv2.imshow('frame',fr/255.0)
-#                 if cv2.waitKey(1) & 0xFF == ord('q'):
-#                     cv2.destroyAllWindows()
-#                     break
-
-             shifts.append([sh_x_n,sh_y_n])
-             xcorrs.append([avg_corr])
-
-
-        return (shifts,xcorrs)
-
-
-
-
-
-    def apply_shifts(self, shifts,interpolation='linear',method='opencv',remove_blanks=False):
+        shifts = np.zeros((n_frames_, 2))   # store the amount of shift in each frame
+        xcorrs = np.zeros((n_frames_, 1))
+        peaks = np.zeros(n_frames_)
+
+        def register_frames(chunk):
+            start, stop = chunk
+            if method == 'fft' and pyramid_levels == 0:
+                for idx in range(start, stop, batch_size):
+                    idx_end = min(idx + batch_size, stop)
+                    res = _xcorr_fft(self[idx:idx_end], template_fft, ms_h, ms_w)
+                    shifts[idx:idx_end], xcorrs[idx:idx_end] = _shifts_from_xcorr(res, ms_h, ms_w)
+                    peaks[idx:idx_end] = np.max(res.reshape((idx_end - idx, -1)), axis=1)
+                return
+
+            for i in range(start, stop):
+                 frame = self[i]
+
+                 if pyramid_levels > 0:
+                     # coarse estimate on the downsampled frame, refined at full resolution
+                     # within +/- factor pixels of it
+                     res = match(_pyr_down(frame, pyramid_levels), coarse_template)
+                     (sh_x_c, sh_y_c), _ = _shift_from_xcorr_window(res, 0, 0, ms_h_c, ms_w_c)
+                     pred_x = int(np.clip(ms_h - np.round(sh_x_c * factor), 0, 2 * ms_h))
+                     pred_y = int(np.clip(ms_w - np.round(sh_y_c * factor), 0, 2 * ms_w))
+                     u0, u1 = max(0, pred_x - factor), min(2 * ms_h, pred_x + factor)
+                     v0, v1 = max(0, pred_y - factor), min(2 * ms_w, pred_y + factor)
+                     res = match(frame[u0:u1 + h, v0:v1 + w], template)
+                 else:
+                     u0, v0 = 0, 0
+                     res = match(frame, template)
+
+                 shifts[i], xcorrs[i] = _shift_from_xcorr_window(res, u0, v0, ms_h, ms_w)
+                 peaks[i] = np.max(res)
+
+        # frames are split in contiguous chunks, each writing its own slice of shifts and xcorrs
+        _map_frame_chunks(register_frames, n_frames_, n_threads)
+
+        if return_metrics:
+            return (shifts.tolist(), xcorrs.tolist(), {'corr': peaks})
+
+        return (shifts.tolist(), xcorrs.tolist())
+
+
+
+
+
+    def apply_shifts(self, shifts,interpolation='linear',method='opencv',remove_blanks=False,n_threads=1,return_metrics=False):
         """
         Apply precomputed shifts to a movie, using subpixels adjustment (cv2.INTER_CUBIC function)
 
@@ -266,74 +444,406 @@ class movie(ts.timeseries):
         ------------
         shifts: array of tuples representing x and y shifts for each frame
         interpolation: 'linear', 'cubic', 'nearest' or cvs.INTER_XXX
+        method: 'opencv', 'skimage' or 'fast'. 'fast' splits each shift in an integer part, applied
+                by slicing, and a fractional part, applied with a separable kernel
+                ('nearest', 'linear' or 'cubic' interpolation only)
+        n_threads: number of threads among which contiguous chunks of frames are split
+        return_metrics: if True also return a dict with the mean ('mean') and variance ('var') images
+                        of the shifted movie and the crispness of the mean image ('crispness', see
+                        quality_metrics), computed in parallel over the same chunks of frames
+        """
+        if type(self[0, 0, 0]) is not np.float32:
+            warnings.warn('Casting the array to float 32')
+            self = np.asanyarray(self, dtype=np.float32)
+
+        if method == 'fast':
+            if interpolation not in ('nearest', 'linear', 'cubic'):
+                raise Exception('Interpolation method not available')
+
+            shifts_arr = np.asarray(shifts, dtype=np.float64)
+
+            def translate_chunk(chunk):
+                start, stop = chunk
+                _translate_frames(self[start:stop], shifts_arr[start:stop], interpolation)
+
+            _map_frame_chunks(translate_chunk, self.shape[0], n_threads)
+
+        else:
+            self = self._warp_affine(shifts, interpolation=interpolation, method=method, n_threads=n_threads)
+
+        if return_metrics:
+            metrics = quality_metrics(*_frame_moments(self, n_threads))
+
+        if remove_blanks:
+            max_h,max_w= np.max(shifts,axis=0)
+            min_h,min_w= np.min(shifts,axis=0)
+            self=self.crop(crop_top=max_h,crop_bottom=-min_h+1,crop_left=max_w,crop_right=-min_w,crop_begin=0,crop_end=0)
+
+        if return_metrics:
+            return self, metrics
+
+        return self
+
+    def register_ecc(self, template, shifts=None, warp_mode='affine', max_iters=100, eps=1e-5,
+                     interpolation='linear', n_threads=1, check_convergence=True):
+        """
+        Register each frame to the template with the enhanced correlation coefficient
+        maximization of opencv (cv2.findTransformECC), which can correct rotations, shears
+        and perspective changes. Frames are warped in place.
+
+        Parameters
+        ----------
+        template: ndarray, the frames are aligned to it
+        shifts: rigid shifts in x and y of each frame (e.g. from extract_shifts), used as starting
+                point of the optimization. If None the identity is used
+        warp_mode: 'translation', 'euclidean', 'affine' or 'homography'
+        max_iters: maximum number of iterations per frame
+        eps: the optimization stops when the correlation coefficient increases less than eps
+        interpolation: 'linear', 'cubic' or 'nearest'
+        n_threads: number of threads among which contiguous chunks of frames are split
+        check_convergence: if True, each frame is optimized a second time with max_iters+1 iterations.
+                           The frame converged (stopped on eps) if the extra iteration was not run,
+                           i.e. the two warps are identical. This doubles the time of the optimization
+
+        Returns
+        -------
+        self: registered movie
+        warps: array (T,2,3) (or (T,3,3) for homography) of warp matrices, mapping the coordinates
+               (column, row) of the template to those of the frame
+        xcorrs: correlation coefficient of each frame with the template
+        info: record array with, for each frame, the fields cc, failed (cv2.findTransformECC raised an
+              error, the frame is warped with the starting point), converged (the optimization stopped
+              because the correlation increased less than eps before max_iters iterations; False if it
+              failed, True for all the other frames if check_convergence is False) and time (seconds
+              spent by the optimization)
         """
+        warp_modes = {'translation': cv2.MOTION_TRANSLATION, 'euclidean': cv2.MOTION_EUCLIDEAN,
+                      'affine': cv2.MOTION_AFFINE, 'homography': cv2.MOTION_HOMOGRAPHY}
+        interpolations = {'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC, 'nearest': cv2.INTER_NEAREST}
+
+        if warp_mode not in warp_modes:
+            raise Exception('Unknown warp mode')
+        if interpolation not in interpolations:
+            raise Exception('Interpolation method not available')
+
         if type(self[0, 0, 0]) is not np.float32:
             warnings.warn('Casting the array to float 32')
             self = np.asanyarray(self, dtype=np.float32)
 
+        t, h, w = self.shape
+        template = np.array(template, dtype=np.float32)
+        mode = warp_modes[warp_mode]
+        flags = interpolations[interpolation] + cv2.WARP_INVERSE_MAP
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iters, eps)
+
+        # the rigid shift moves the frame by (sh_x_n, sh_y_n), the warp maps back the template coordinates
+        warps = np.tile(np.eye(3, dtype=np.float32), (t, 1, 1))
+        if shifts is not None:
+            shifts = np.asarray(shifts, dtype=np.float32)
+            warps[:, 0, 2] = -shifts[:, 1]
+            warps[:, 1, 2] = -shifts[:, 0]
+        if mode != cv2.MOTION_HOMOGRAPHY:
+            warps = np.ascontiguousarray(warps[:, :2])
+
+        info = np.zeros(t, dtype=[('cc', np.float32), ('failed', np.bool), ('converged', np.bool), ('time', np.float32)])
+        criteria_check = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iters + 1, eps)
+
+        def register_frames(chunk):
+            start, stop = chunk
+            for i in range(start, stop):
+                t0 = time.time()
+                try:
+                    cc, warp = _find_transform_ecc(template, self[i], warps[i].copy(), mode, criteria)
+                    converged = True
+                    if check_convergence:
+                        # the extra iteration only runs if eps was not reached within max_iters
+                        _, warp_check = _find_transform_ecc(template, self[i], warps[i].copy(), mode, criteria_check)
+                        converged = np.array_equal(warp, warp_check)
+                    warps[i] = warp
+                    info[i] = (cc, False, converged, time.time() - t0)
+                except cv2.error:
+                    info[i] = (np.nan, True, False, time.time() - t0)
+
+                if mode == cv2.MOTION_HOMOGRAPHY:
+                    self[i] = cv2.warpPerspective(self[i], warps[i], (w, h), flags=flags)
+                else:
+                    self[i] = cv2.warpAffine(self[i], warps[i], (w, h), flags=flags)
+
+        _map_frame_chunks(register_frames, t, n_threads)
+
+        return self, warps, info['cc'][:, None].tolist(), info.view(np.recarray)
+
+    def _warp_affine(self, shifts, interpolation='linear', method='opencv', n_threads=1):
+        """
+        Shift the frames in place with cv2.warpAffine or skimage.transform.warp (see apply_shifts)
+        """
         if interpolation == 'cubic':
             if method == 'opencv':
                 interpolation=cv2.INTER_CUBIC
             else:
                 interpolation=3
-            print 'cubic interpolation'
 
         elif interpolation == 'nearest':
             if method == 'opencv':
                 interpolation=cv2.INTER_NEAREST
             else:
                 interpolation=0
-            print 'nearest interpolation'
 
         elif interpolation == 'linear':
             if method=='opencv':
                 interpolation=cv2.INTER_LINEAR
             else:
                 interpolation=1
-            print 'linear interpolation'
         elif interpolation == 'area':
             if method=='opencv':
                 interpolation=cv2.INTER_AREA
             else:
                 raise Exception('Method not defined')
-            print 'area interpolation'
         elif interpolation == 'lanczos4':
             if method=='opencv':
                 interpolation=cv2.INTER_LANCZOS4
             else:
                 interpolation=4
-            print 'lanczos/biquartic interpolation'
 
         else:
             raise Exception('Interpolation method not available')
 
 
+        if method not in ('opencv', 'skimage'):
+            raise Exception('Unknown shift  application method')
+
         t,h,w=self.shape
-        for i,frame in enumerate(self):
 
-             if i%100==99:
-                 print "Frame %i"%(i+1);
+        def warp_frames(chunk):
+            start, stop = chunk
+            for i in range(start, stop):
+                 frame = self[i]
 
-             sh_x_n, sh_y_n = shifts[i]
+                 sh_x_n, sh_y_n = shifts[i]
 
-             if method == 'opencv':
-                 M = np.float32([[1,0,sh_y_n],[0,1,sh_x_n]])
-                 self[i] = cv2.warpAffine(frame,M,(w,h),flags=interpolation)
-             elif method == 'skimage':
+                 if method == 'opencv':
+                     M = np.float32([[1,0,sh_y_n],[0,1,sh_x_n]])
+                     self[i] = cv2.warpAffine(frame,M,(w,h),flags=interpolation)
+                 elif method == 'skimage':
 
-                 tform = AffineTransform(translation=(-sh_y_n,-sh_x_n))
-                 self[i] = warp(frame, tform,preserve_range=True,order=interpolation)
+                     tform = AffineTransform(translation=(-sh_y_n,-sh_x_n))
+                     self[i] = warp(frame, tform,preserve_range=True,order=interpolation)
 
-             else:
-                 raise Exception('Unknown shift  application method')
+        # every chunk of frames is warped in place, in its own slice of the movie
+        _map_frame_chunks(warp_frames, t, n_threads)
 
-        if remove_blanks:
-            max_h,max_w= np.max(shifts,axis=0)
-            min_h,min_w= np.min(shifts,axis=0)
-            self=self.crop(crop_top=max_h,crop_bottom=-min_h+1,crop_left=max_w,crop_right=-min_w,crop_begin=0,crop_end=0)
+        return self
+
+
+    def motion_correct_piecewise(self, max_shift_w=5, max_shift_h=5, template=None,
+                                 strides=(96, 96), overlaps=(32, 32), num_frames_template=None,
+                                 method='opencv', interpolation='cubic', batch_size=20, n_threads=1):
+        """
+        Piecewise rigid motion correction. Shifts are estimated on an overlapping grid
+        of patches, upsampled to a smooth shift field and applied with a single remap per frame
+
+        Parameters
+        ----------
+        max_shift_w,max_shift_h: maximum pixel shifts allowed for each patch
+        template: if None, it is the template of a rigid motion correction of a subsample of the movie
+        strides,overlaps: distance between the beginnings of two patches and number of pixels they share,
+                          along height and width. Patches have size strides+overlaps
+        num_frames_template: number of frames used to compute the template
+        method: method used for the rigid correction that builds the template (see motion_correct)
+        interpolation,batch_size,n_threads: see apply_shifts_piecewise and extract_shifts_piecewise
+
+        Returns
+        -------
+        self: motion corrected movie
+        shifts: ndarray (T,n_patches_h,n_patches_w,2), shifts of each patch
+        xcorrs: ndarray (T,n_patches_h,n_patches_w,1), cross correlation of each patch with the template
+        template: the template used
+        """
+        if template is None:
+            template = self._rigid_template(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                            num_frames_template=num_frames_template,
+                                            method=method, n_threads=n_threads)
+
+        shifts, xcorrs = self.extract_shifts_piecewise(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                                       template=template, strides=strides, overlaps=overlaps,
+                                                       batch_size=batch_size, n_threads=n_threads)
+        self = self.apply_shifts_piecewise(shifts, strides=strides, overlaps=overlaps,
+                                           interpolation=interpolation, n_threads=n_threads)
+
+        return self, shifts, xcorrs, template
+
+    def extract_shifts_piecewise(self, max_shift_w=5, max_shift_h=5, template=None,
+                                 strides=(96, 96), overlaps=(32, 32), batch_size=20, n_threads=1):
+        """
+        Estimate the rigid shift of every patch of an overlapping grid. All the patches of a
+        batch of frames are registered together with the FFT engine of extract_shifts
+
+        Parameters
+        ----------
+        max_shift_w,max_shift_h: maximum pixel shifts allowed for each patch
+        template: if a good template is available it can be passed. If None the median is used
+        strides,overlaps: see motion_correct_piecewise
+        batch_size: number of frames whose patches are registered together
+        n_threads: number of threads among which contiguous chunks of frames are split
+
+        Returns
+        -------
+        shifts: ndarray (T,n_patches_h,n_patches_w,2), shifts in x and y of each patch
+        xcorrs: ndarray (T,n_patches_h,n_patches_w,1), average correlation of each patch with the template
+        """
+        if type(self[0, 0, 0]) is not np.float32:
+            warnings.warn('Casting the array to float 32')
+            self = np.asanyarray(self, dtype=np.float32)
+
+        n_frames_, h_i, w_i = self.shape
+        ms_h, ms_w = max_shift_h, max_shift_w
+
+        if template is None:
+            template = np.median(self, axis=0)
+
+        ys, xs, _, _, (ph, pw) = _patch_grid((h_i, w_i), strides, overlaps)
+        if ph <= 2 * ms_h or pw <= 2 * ms_w:
+            raise Exception('Patches must be larger than twice the maximum shift')
+
+        templates = np.array([template[y + ms_h:y + ph - ms_h, x + ms_w:x + pw - ms_w] for y in ys for x in xs])
+        template_fft = _fft_template(templates, (ph, pw))
+
+        shifts = np.zeros((n_frames_, len(ys), len(xs), 2))
+        xcorrs = np.zeros((n_frames_, len(ys), len(xs), 1))
+
+        def register_patches(chunk):
+            start, stop = chunk
+            for idx in range(start, stop, batch_size):
+                idx_end = min(idx + batch_size, stop)
+                frames = self[idx:idx_end]
+                patches = np.stack([frames[:, y:y + ph, x:x + pw] for y in ys for x in xs], axis=1)
+                res = _xcorr_fft(patches, template_fft, ms_h, ms_w)
+                sh, xc = _shifts_from_xcorr(res, ms_h, ms_w)
+                shifts[idx:idx_end] = sh.reshape((idx_end - idx, len(ys), len(xs), 2))
+                xcorrs[idx:idx_end] = xc.reshape((idx_end - idx, len(ys), len(xs), 1))
+
+        _map_frame_chunks(register_patches, n_frames_, n_threads)
+
+        return shifts, xcorrs
+
+    def apply_shifts_piecewise(self, shifts, strides=(96, 96), overlaps=(32, 32),
+                               interpolation='cubic', n_threads=1):
+        """
+        Apply the patch shifts computed by extract_shifts_piecewise. The shifts are linearly
+        interpolated between the centers of the patches and every frame is warped with one cv2.remap
+
+        Parameters
+        ----------
+        shifts: ndarray (T,n_patches_h,n_patches_w,2)
+        strides,overlaps: same values used to extract the shifts
+        interpolation: 'linear', 'cubic', 'nearest' or cv2.INTER_XXX
+        n_threads: number of threads among which contiguous chunks of frames are split
+        """
+        if type(self[0, 0, 0]) is not np.float32:
+            warnings.warn('Casting the array to float 32')
+            self = np.asanyarray(self, dtype=np.float32)
+
+        interpolation = {'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC,
+                         'nearest': cv2.INTER_NEAREST}.get(interpolation, interpolation)
+
+        t, h, w = self.shape
+        _, _, centers_y, centers_x, _ = _patch_grid((h, w), strides, overlaps)
+        interp_y = _interp_matrix(centers_y, h)
+        interp_x = _interp_matrix(centers_x, w)
+        grid_x, grid_y = np.meshgrid(np.arange(w, dtype=np.float32), np.arange(h, dtype=np.float32))
+        shifts = np.asarray(shifts)
+
+        def remap_frames(chunk):
+            start, stop = chunk
+            for i in range(start, stop):
+                sh_x = interp_y.dot(shifts[i, :, :, 0]).dot(interp_x.T).astype(np.float32)
+                sh_y = interp_y.dot(shifts[i, :, :, 1]).dot(interp_x.T).astype(np.float32)
+                self[i] = cv2.remap(self[i], grid_x - sh_y, grid_y - sh_x, interpolation,
+                                    borderMode=cv2.BORDER_CONSTANT)
+
+        _map_frame_chunks(remap_frames, t, n_threads)
 
         return self
 
+    def motion_correct_lk(self, max_shift_w=5, max_shift_h=5, template=None, n_basis=16,
+                          num_frames_template=None, max_iters=25, min_iters=5, deltacorr=0.0005,
+                          method='opencv', batch_size=32, n_threads=1):
+        """
+        Line by line b-spline Lucas Kanade motion correction (Selmaan Chettih algorithm). It corrects
+        the distortions within a frame (e.g. resonant scanners) by displacing every row of the frame
+        along a linear b-spline. Frames are initialized with the rigid shifts and registered in batches
+        (see motion_correction.lucas_kanade_frames)
+
+        Parameters
+        ----------
+        max_shift_w,max_shift_h: maximum pixel shifts allowed for the rigid initialization
+        template: if None, it is the template of a rigid motion correction of a subsample of the movie
+        n_basis: number of intervals between the knots of the b-splines
+        num_frames_template: number of frames used to compute the template
+        max_iters,min_iters,deltacorr: convergence parameters of the Lucas Kanade iterations
+        method: method used for the rigid shifts (see motion_correct)
+        batch_size: number of frames registered together
+        n_threads: number of threads among which contiguous chunks of frames are split
+
+        Returns
+        -------
+        self: motion corrected movie
+        shifts: ndarray (T,n_basis+1,2), shifts in x and y at the knots of the b-splines
+        xcorrs: ndarray (T,1) correlation of each corrected frame with the template
+        template: the template used
+        """
+        if type(self[0, 0, 0]) is not np.float32:
+            warnings.warn('Casting the array to float 32')
+            self = np.asanyarray(self, dtype=np.float32)
+
+        if template is None:
+            template = self._rigid_template(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                            num_frames_template=num_frames_template,
+                                            method=method, n_threads=n_threads)
+
+        template = np.asarray(template, dtype=np.float32)
+        rigid_shifts, _ = self.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                              template=template, method=method, n_threads=n_threads)
+        rigid_shifts = np.array(rigid_shifts)
+
+        t, h, w = self.shape
+        B, allBs = mc.bspline_basis(h, n_basis)
+        shifts = np.zeros((t, n_basis + 1, 2))
+        xcorrs = np.zeros((t, 1))
+
+        def register_frames(chunk):
+            start, stop = chunk
+            for idx in range(start, stop, batch_size):
+                idx_end = min(idx + batch_size, stop)
+                # the rigid shift is a constant displacement of all the knots
+                dpy = -np.repeat(rigid_shifts[idx:idx_end, :1], n_basis + 1, axis=1)
+                dpx = -np.repeat(rigid_shifts[idx:idx_end, 1:], n_basis + 1, axis=1)
+                Id, dpx, dpy, corrs, _ = mc.lucas_kanade_frames(template, np.asarray(self[idx:idx_end]),
+                                                                n_basis=n_basis, dpx=dpx, dpy=dpy,
+                                                                max_iters=max_iters, min_iters=min_iters,
+                                                                deltacorr=deltacorr, B=B, allBs=allBs)
+                self[idx:idx_end] = Id
+                shifts[idx:idx_end, :, 0] = -dpy
+                shifts[idx:idx_end, :, 1] = -dpx
+                xcorrs[idx:idx_end, 0] = corrs
+
+        _map_frame_chunks(register_frames, t, n_threads)
+
+        return self, shifts, xcorrs, template
+
+    def _rigid_template(self, max_shift_w=5, max_shift_h=5, num_frames_template=None, method='opencv', n_threads=1):
+        """
+        Template of the rigid motion correction of a strided subsample of the movie
+        """
+        if num_frames_template is None:
+            num_frames_template = 10e7/(512*512)
+
+        frames_to_skip = int(np.maximum(1, self.shape[0]/num_frames_template))
+        submov = self[::frames_to_skip].copy()
+        _, _, _, template = submov.motion_correct(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                                  method=method, n_threads=n_threads)
+        # motion_correct returns the template of the movie shifted to non negative values
+        return template + np.min(np.mean(submov, axis=0))
 
     def debleach(self):
         """ Debleach by fiting a model to the median intensity.
@@ -638,52 +1148,14 @@ class movie(ts.timeseries):
          rho M x N matrix, cross-correlation with adjacent pixel
          '''
 
-         rho = np.zeros(np.shape(self)[1:3])
          w_mov = (self - np.mean(self, axis = 0))/np.std(self, axis = 0)
 
          rho_h = np.mean(np.multiply(w_mov[:,:-1,:], w_mov[:,1:,:]), axis = 0)
          rho_w = np.mean(np.multiply(w_mov[:,:,:-1], w_mov[:,:,1:,]), axis = 0)
+         rho_d1 = np.mean(np.multiply(w_mov[:,1:,:-1], w_mov[:,:-1,1:,]), axis = 0)
+         rho_d2 = np.mean(np.multiply(w_mov[:,:-1,:-1], w_mov[:,1:,1:,]), axis = 0)
 
-         if True:
-             rho_d1 = np.mean(np.multiply(w_mov[:,1:,:-1], w_mov[:,:-1,1:,]), axis = 0)
-             rho_d2 = np.mean(np.multiply(w_mov[:,:-1,:-1], w_mov[:,1:,1:,]), axis = 0)
-
-
-         rho[:-1,:] = rho[:-1,:] + rho_h
-         rho[1:,:] = rho[1:,:] + rho_h
-         rho[:,:-1] = rho[:,:-1] + rho_w
-         rho[:,1:] = rho[:,1:] + rho_w
-
-         if eight_neighbours:
-             rho[:-1,:-1] = rho[:-1,:-1] + rho_d2
-             rho[1:,1:] = rho[1:,1:] + rho_d1
-             rho[1:,:-1] = rho[1:,:-1] + rho_d1
-             rho[:-1,1:] = rho[:-1,1:] + rho_d2
-
-
-         if eight_neighbours:
-             neighbors = 8 * np.ones(np.shape(self)[1:3])
-             neighbors[0,:] = neighbors[0,:] - 3;
-             neighbors[-1,:] = neighbors[-1,:] - 3;
-             neighbors[:,0] = neighbors[:,0] - 3;
-             neighbors[:,-1] = neighbors[:,-1] - 3;
-             neighbors[0,0] = neighbors[0,0] + 1;
-             neighbors[-1,-1] = neighbors[-1,-1] + 1;
-             neighbors[-1,0] = neighbors[-1,0] + 1;
-             neighbors[0,-1] = neighbors[0,-1] + 1;
-         else:
-             neighbors = 4 * np.ones(np.shape(self)[1:3])
-             neighbors[0,:] = neighbors[0,:] - 1;
-             neighbors[-1,:] = neighbors[-1,:] - 1;
-             neighbors[:,0] = neighbors[:,0] - 1;
-             neighbors[:,-1] = neighbors[:,-1] - 1;
-
-
-
-
-         rho = np.divide(rho, neighbors)
-
-         return rho
+         return _neighbours_correlations(rho_h, rho_w, rho_d1, rho_d2, eight_neighbours)
 
     def partition_FOV_KMeans(self,tradeoff_weight=.5,fx=.25,fy=.25,n_clusters=4,max_iter=500):
         """
@@ -986,137 +1458,930 @@ class movie(ts.timeseries):
 
 
 
-def load(file_name,fr=None,start_time=0,meta_data=None,subindices=None,shape=None):
-    '''
-    load movie from file.
+def _map_frame_chunks(func, n_frames, n_threads=1):
+    """
+    Split the frame axis in n_threads contiguous chunks and apply func to each of them
 
     Parameters
-    -----------
-    file_name: string
-        name of file. Possible extensions are tif, avi, npy, (npz and hdf5 are usable only if saved by calblitz)
-    fr: float
-        frame rate
-    start_time: float
-        initial time for frame 1
-    meta_data: dict
-        same as for calblitz.movie
-    subindices: iterable indexes
-        for loading only portion of the movie
-    shape: tuple of two values
-        dimension of the movie along x and y if loading from a two dimensional numpy array
+    ----------
+    func: function taking a tuple (start, stop) of frame indices
+    n_frames: int, number of frames
+    n_threads: int, number of threads of the pool. cv2 functions release the GIL,
+               so the chunks run concurrently
 
     Returns
     -------
-    mov: calblitz.movie
+    list with the output of func for each chunk
+    """
+    bounds = np.linspace(0, n_frames, max(1, n_threads) + 1).astype(np.int)
+    chunks = [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
 
-    '''
+    if n_threads > 1 and len(chunks) > 1:
+        pool = ThreadPool(len(chunks))
+        try:
+            return pool.map(func, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        return map(func, chunks)
 
-    # case we load movie from file
-    if os.path.exists(file_name):
 
-        name, extension = os.path.splitext(file_name)[:2]
+def _prefetch_chunks(read, bounds, prefetch=0):
+    """
+    Generator of read(b) for b in bounds. With prefetch > 0 a background thread reads the next
+    prefetch chunks in order while the current one is processed (one reader, so file handles
+    are never shared between concurrent reads)
+    """
+    if prefetch <= 0:
+        for b in bounds:
+            yield read(b)
+        return
+
+    pool = ThreadPool(1)
+    try:
+        pending = [pool.apply_async(read, (b,)) for b in bounds[:prefetch + 1]]
+        for b in bounds[prefetch + 1:]:
+            chunk = pending.pop(0).get()
+            pending.append(pool.apply_async(read, (b,)))
+            yield chunk
+        for res in pending:
+            yield res.get()
+    finally:
+        pool.close()
+        pool.join()
+
+
+def map_chunks(func, chunks, out=None):
+    """
+    Apply a per-frame operation to a sequence of chunks of frames, writing the results one after the
+    other to out. With the prefetching iter_chunks of a lazy_movie as input and a memory mapped or hdf5
+    output, reading, processing and writing overlap and only a few chunks are in memory
 
-        if extension == '.tif' or extension == '.tiff':  # load avi file
-            if subindices is not None:
-                input_arr = imread(file_name)[subindices, :, :]
-            else:
-                input_arr = imread(file_name)
-            input_arr = np.squeeze(input_arr)
+    Parameters
+    ----------
+    func: function taking a chunk (calblitz.movie) and returning the processed frames
+    chunks: iterable of chunks (e.g. movie.iter_chunks(chunk_frames, prefetch=1))
+    out: preallocated array, np.memmap or h5py dataset with the shape of the output.
+         If None the processed chunks are concatenated in a calblitz.movie
 
-#            with pims.open(file_name) as f:
-#                if len(f.frame_shape)==3:
-#                    for ext_fr in f:
-#                        if subindices is None:
-#                            input_arr = np.array(ext_fr)
-#                        else:
-#                            input_arr = np.array([ext_fr[j] for j in subindices])
-#                elif len(f.frame_shape)==2:
-#                        if subindices is None:
-#                            input_arr = np.array(f)
-#                        else:
-#                            input_arr = np.array([f[j] for j in subindices])
-#                else:
-#                    raise Exception('The input file has an unknown numberof dimensions')
+    Returns
+    -------
+    out
+    """
+    if out is None:
+        res = [func(chunk) for chunk in chunks]
+        out = np.concatenate(res, axis=0)
+        if isinstance(res[0], movie):
+            out = movie(out, fr=res[0].fr, start_time=res[0].start_time, file_name=res[0].file_name, meta_data=res[0].meta_data)
+        return out
 
-            # necessary for the way pims work with tiffs
-#            input_arr = input_arr[:,::-1,:]
+    idx = 0
+    for chunk in chunks:
+        res = func(chunk)
+        out[idx:idx + len(res)] = res
+        idx += len(res)
 
-        elif extension == '.avi': # load avi file
-            #raise Exception('Use sintax mov=cb.load(filename)')
-            if subindices is not None:
-                raise Exception('Subindices not implemented')
-            cap = cv2.VideoCapture(file_name)
-            try:
-                length = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-                width  = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            except:
-                print 'Roll back top opencv 2'
-                length = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
-                width  = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH))
-                height = int(cap.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT))
-
-            input_arr=np.zeros((length, height,width),dtype=np.uint8)
-            counter=0
-            ret=True
-            while True:
-                # Capture frame-by-frame
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                input_arr[counter]=frame[:,:,0]
-                counter=counter+1
-                if not counter%100:
-                    print counter
+    if idx != len(out):
+        raise Exception('The output has %d frames, %d were written' % (len(out), idx))
 
-            # When everything done, release the capture
-            cap.release()
-            cv2.destroyAllWindows()
+    return out
 
-        elif extension == '.npy': # load npy file
-            if subindices is not None:
-                input_arr=np.load(file_name)[subindices]
-            else:
-                input_arr=np.load(file_name)
-            if input_arr.ndim==2:
-                if shape is not None:
-                    d,T=np.shape(input_arr)
-                    d1,d2=shape
-                    input_arr=np.transpose(np.reshape(input_arr,(d1,d2,T),order='F'),(2,0,1))
-                else:
-                    raise Exception('Loaded vector is 2D , you need to provide the shape parameter')
 
-        elif extension == '.mat': # load npy file
-            input_arr=loadmat(file_name)['data']
-            input_arr=np.rollaxis(input_arr,2,-3)
-            if subindices is not None:
-                input_arr=input_arr[subindices]
+def quality_metrics(n_frames, mean, m2):
+    """
+    Quality metrics of a motion corrected movie from its moments (see _frame_moments)
 
+    Parameters
+    ----------
+    n_frames: number of frames
+    mean: mean image
+    m2: sum over the frames of the squared deviations from the mean image
 
-        elif extension == '.npz': # load movie from saved file
-            if subindices is not None:
-                raise Exception('Subindices not implemented')
-            with np.load(file_name) as f:
-                return movie(**f)
+    Returns
+    -------
+    dict with the number of frames ('n_frames'), the mean image ('mean'), the variance image ('var')
+    and the crispness of the mean image ('crispness'), the norm of its gradient. The better the
+    registration, the sharper the mean image and the higher its crispness
+    """
+    mean = np.asarray(mean, dtype=np.float32)
+    grad_y, grad_x = np.gradient(mean)
+    return {'mean': mean, 'var': np.asarray(m2 / max(n_frames, 1), dtype=np.float32),
+            'crispness': np.sqrt(np.sum(grad_x ** 2 + grad_y ** 2)), 'n_frames': n_frames}
 
-        elif extension== '.hdf5':
-            with h5py.File(file_name, "r") as f:
-                attrs=dict(f['mov'].attrs)
-                attrs['meta_data']=cpk.loads(attrs['meta_data'])
+
+def _frame_moments(frames, n_threads=1):
+    """
+    Number of frames, mean image and sum of squared deviations from it, each thread
+    computing the moments of a contiguous chunk of frames (see _merge_moments)
+    """
+    def moments(chunk):
+        start, stop = chunk
+        mean = np.mean(frames[start:stop], axis=0, dtype=np.float64)
+        m2 = np.sum((frames[start:stop] - mean) ** 2, axis=0)
+        return stop - start, mean, m2
+
+    return reduce(_merge_moments, _map_frame_chunks(moments, frames.shape[0], n_threads), (0, 0, 0))
+
+
+def _merge_moments(a, b):
+    """
+    Moments (n, mean, m2) of the union of two sets of frames (Chan et al. parallel algorithm)
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    if n_a == 0:
+        return b
+    if n_b == 0:
+        return a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return n, mean_a + delta * n_b / n, m2_a + m2_b + delta ** 2 * n_a * n_b / n
+
+
+def _neighbours_correlations(rho_h, rho_w, rho_d1, rho_d2, eight_neighbours=False):
+    """
+    Average correlation of each pixel with its neighbours, from the correlations of the
+    pairs of vertical (rho_h), horizontal (rho_w) and diagonal (rho_d1, rho_d2) neighbours
+    (see movie.local_correlations)
+    """
+    rho = np.zeros((rho_w.shape[0], rho_h.shape[1]))
+
+    rho[:-1,:] = rho[:-1,:] + rho_h
+    rho[1:,:] = rho[1:,:] + rho_h
+    rho[:,:-1] = rho[:,:-1] + rho_w
+    rho[:,1:] = rho[:,1:] + rho_w
+
+    if eight_neighbours:
+        rho[:-1,:-1] = rho[:-1,:-1] + rho_d2
+        rho[1:,1:] = rho[1:,1:] + rho_d1
+        rho[1:,:-1] = rho[1:,:-1] + rho_d1
+        rho[:-1,1:] = rho[:-1,1:] + rho_d2
+
+    if eight_neighbours:
+        neighbors = 8 * np.ones(rho.shape)
+        neighbors[0,:] = neighbors[0,:] - 3;
+        neighbors[-1,:] = neighbors[-1,:] - 3;
+        neighbors[:,0] = neighbors[:,0] - 3;
+        neighbors[:,-1] = neighbors[:,-1] - 3;
+        neighbors[0,0] = neighbors[0,0] + 1;
+        neighbors[-1,-1] = neighbors[-1,-1] + 1;
+        neighbors[-1,0] = neighbors[-1,0] + 1;
+        neighbors[0,-1] = neighbors[0,-1] + 1;
+    else:
+        neighbors = 4 * np.ones(rho.shape)
+        neighbors[0,:] = neighbors[0,:] - 1;
+        neighbors[-1,:] = neighbors[-1,:] - 1;
+        neighbors[:,0] = neighbors[:,0] - 1;
+        neighbors[:,-1] = neighbors[:,-1] - 1;
+
+    return np.divide(rho, neighbors)
+
+
+def _find_transform_ecc(template, frame, warp, mode, criteria):
+    """
+    cv2.findTransformECC, opencv 4.1 and 4.2 require the mask and the size of the gaussian filter
+    """
+    try:
+        return cv2.findTransformECC(template, frame, warp, mode, criteria)
+    except TypeError:
+        return cv2.findTransformECC(template, frame, warp, mode, criteria, None, 1)
+
+
+def _translation_taps(shifts, interpolation):
+    """
+    Decompose shifts along one axis in an integer shift and the taps of a separable interpolation kernel,
+    so that out[r] = sum_o weights[o] * src[r + o - k]
+
+    Parameters
+    ----------
+    shifts: array (T,) of shifts of the frames along one axis
+    interpolation: 'nearest', 'linear' or 'cubic' (Keys kernel with a=-0.75, as in opencv)
+
+    Returns
+    -------
+    k: array (T,) of integer shifts
+    weights: array (T, n_taps) of weights of the kernel
+    offsets: list of n_taps offsets of the taps
+    """
+    if interpolation == 'nearest':
+        return np.round(shifts).astype(np.int), np.ones((len(shifts), 1), dtype=np.float32), [0]
+
+    # the source sample r - shift lies between src[r - k] and src[r - k + 1], at distance t from the first
+    k = np.floor(shifts).astype(np.int) + 1
+    t = (k - shifts)[:, None]
+
+    if interpolation == 'linear':
+        return k, np.hstack([1 - t, t]).astype(np.float32), [0, 1]
+
+    elif interpolation == 'cubic':
+        a = -0.75
+        d = np.abs(t + np.array([1, 0, -1, -2])[None, :])
+        weights = np.where(d <= 1, ((a + 2) * d - (a + 3)) * d * d + 1,
+                           np.where(d < 2, ((a * d - 5 * a) * d + 8 * a) * d - 4 * a, 0))
+        return k, weights.astype(np.float32), [-1, 0, 1, 2]
+
+    else:
+        raise Exception('Interpolation method not available')
+
+
+def _translate_frames(frames, shifts, interpolation):
+    """
+    Translate a block of frames in place. The integer part of each shift is applied by copying a
+    slice of the frame, the fractional part with one separable kernel (cv2.sepFilter2D) over the
+    slice padded with the few rows and columns the taps need. Frames whose shifts are integer are
+    only copied. Pixels coming from outside the frame are 0.
+
+    Parameters
+    ----------
+    frames: float32 array (T, d1, d2)
+    shifts: array (T, 2) of shifts in x and y
+    interpolation: see _translation_taps
+    """
+    T, h, w = frames.shape
+    k_x, w_x, offsets = _translation_taps(shifts[:, 0], interpolation)
+    k_y, w_y, _ = _translation_taps(shifts[:, 1], interpolation)
+    integer = np.all(shifts == np.round(shifts), axis=1) | (interpolation == 'nearest')
+
+    lo, hi = offsets[0], offsets[-1]
+    # the padded frame holds g[r] = src[r - k] for r in [lo, h + hi)
+    buf = np.zeros((h + hi - lo, w + hi - lo), dtype=np.float32)
+
+    for i in range(T):
+        if integer[i]:
+            sh_x, sh_y = np.round(shifts[i]).astype(np.int)
+            _copy_shifted(frames[i], frames[i], sh_x, sh_y, 0, h, 0, w)
+        else:
+            _copy_shifted(frames[i], buf, k_x[i], k_y[i], lo, h + hi, lo, w + hi)
+            frames[i] = cv2.sepFilter2D(buf, -1, w_y[i], w_x[i], anchor=(0, 0),
+                                        borderType=cv2.BORDER_CONSTANT)[:h, :w]
+
+
+def _copy_shifted(src, dst, k_x, k_y, r_start, r_stop, c_start, c_stop):
+    """
+    dst[r - r_start, c - c_start] = src[r - k_x, c - k_y] for r in [r_start, r_stop), c in [c_start, c_stop),
+    0 where the source is outside of src. src and dst can be the same array
+    """
+    h, w = src.shape
+    r0, r1 = max(r_start, k_x), min(r_stop, h + k_x)
+    c0, c1 = max(c_start, k_y), min(c_stop, w + k_y)
+    r0, c0 = min(r0, r_stop), min(c0, c_stop)
+    r1, c1 = max(r1, r0), max(c1, c0)
+    if r1 > r0 and c1 > c0:
+        dst[r0 - r_start:r1 - r_start, c0 - c_start:c1 - c_start] = src[r0 - k_x:r1 - k_x, c0 - k_y:c1 - k_y]
+
+    dst[:r0 - r_start] = 0
+    dst[r1 - r_start:] = 0
+    dst[r0 - r_start:r1 - r_start, :c0 - c_start] = 0
+    dst[r0 - r_start:r1 - r_start, c1 - c_start:] = 0
+
+
+def _patch_grid(shape, strides, overlaps):
+    """
+    Overlapping grid of patches of size strides+overlaps covering a frame
+
+    Returns
+    -------
+    ys, xs: beginnings of the patches along height and width
+    centers_y, centers_x: centers of the patches along height and width
+    size: (height, width) of the patches, clamped to the size of the frame
+    """
+    grid = []
+    for dim, stride, overlap in zip(shape, strides, overlaps):
+        size = min(stride + overlap, dim)
+        starts = range(0, dim - size, stride) + [dim - size]
+        grid.append((np.array(starts), np.array(starts) + (size - 1) / 2., size))
+
+    (ys, centers_y, ph), (xs, centers_x, pw) = grid
+    return ys, xs, centers_y, centers_x, (ph, pw)
+
+
+def _interp_matrix(centers, n):
+    """
+    Matrix (n, len(centers)) that linearly interpolates values defined at the centers
+    over n pixels, constant outside the first and last center
+    """
+    mat = np.zeros((n, len(centers)))
+    if len(centers) == 1:
+        mat[:] = 1
+        return mat
+
+    pos = np.interp(np.arange(n), centers, np.arange(len(centers)))
+    low = np.minimum(np.floor(pos).astype(np.int), len(centers) - 2)
+    frac = pos - low
+    mat[np.arange(n), low] = 1 - frac
+    mat[np.arange(n), low + 1] += frac
+    return mat
+
+
+def _pyr_down(img, levels):
+    """
+    Downsample an image levels times by a factor 2 with cv2.pyrDown
+    """
+    for _ in range(levels):
+        img = cv2.pyrDown(img)
+    return img
+
+
+def _shift_from_xcorr_window(res, u0, v0, ms_h, ms_w):
+    """
+    Shift of the peak of a correlation surface with gaussian subpixel refinement
+
+    Parameters
+    ----------
+    res: ndarray, 2D window of the correlation surface
+    u0, v0: position of the first element of the window in the full surface of size (2*ms_h+1, 2*ms_w+1)
+    ms_h, ms_w: maximum shifts along height and width
+
+    Returns
+    -------
+    shifts: list with shifts in x and y
+    avg_corr: average correlation over the window
+    """
+    top_left = np.unravel_index(np.argmax(res), res.shape)
+    sh_x, sh_y = top_left[0] + u0, top_left[1] + v0
+
+    if (0 < top_left[0] < res.shape[0]-1) & (0 < top_left[1] < res.shape[1]-1) & \
+       (0 < sh_x < 2 * ms_h-1) & (0 < sh_y < 2 * ms_w-1):
+        # if max is internal, check for subpixel shift using gaussian
+        # peak registration
+        x, y = top_left
+        log_xm1_y = np.log(res[x-1,y]);
+        log_xp1_y = np.log(res[x+1,y]);
+        log_x_ym1 = np.log(res[x,y-1]);
+        log_x_yp1 = np.log(res[x,y+1]);
+        four_log_xy = 4*np.log(res[x,y]);
+
+        sh_x_n = -(sh_x - ms_h + (log_xm1_y - log_xp1_y) / (2 * log_xm1_y - four_log_xy + 2 * log_xp1_y))
+        sh_y_n = -(sh_y - ms_w + (log_x_ym1 - log_x_yp1) / (2 * log_x_ym1 - four_log_xy + 2 * log_x_yp1))
+    else:
+        sh_x_n = -(sh_x - ms_h)
+        sh_y_n = -(sh_y - ms_w)
+
+    return [sh_x_n, sh_y_n], np.mean(res)
+
+
+def _fft_template(template, frame_shape):
+    """
+    Precompute what the batched FFT registration needs from a (cropped) template
+
+    Parameters
+    ----------
+    template: ndarray, 2D (or stack of 2D templates broadcasting against the frames)
+    frame_shape: tuple, (height, width) of the frames that will be registered
+
+    Returns
+    -------
+    tuple with conjugate template spectrum, template energy, template shape and FFT shape
+    """
+    h_i, w_i = frame_shape
+    fshape = (cv2.getOptimalDFTSize(h_i), cv2.getOptimalDFTSize(w_i))
+    template = np.asarray(template, dtype=np.float64)
+    templ_fft = np.conj(np.fft.rfft2(template, s=fshape))
+    templ_energy = np.sum(template**2, axis=(-2, -1))
+    return templ_fft, templ_energy, template.shape[-2:], fshape
+
+
+def _xcorr_fft(frames, template_fft, ms_h, ms_w):
+    """
+    Normalized cross correlation (as cv2.TM_CCORR_NORMED) of a block of frames
+    with a template, restricted to shifts within +/- ms_h, ms_w
+
+    Parameters
+    ----------
+    frames: ndarray, (..., height, width)
+    template_fft: output of _fft_template
+    ms_h, ms_w: maximum shifts along height and width
+
+    Returns
+    -------
+    res: ndarray, (..., 2*ms_h+1, 2*ms_w+1) correlation surfaces
+    """
+    templ_fft, templ_energy, (h, w), fshape = template_fft
+    frames = np.asarray(frames, dtype=np.float64)
+    h_i, w_i = frames.shape[-2:]
+    n_h, n_w = 2 * ms_h + 1, 2 * ms_w + 1
+
+    # only the first n_h rows of the correlation are needed, so the inverse
+    # transform along the width is restricted to those
+    xcorr = np.fft.ifft(np.fft.rfft2(frames, s=fshape) * templ_fft, axis=-2)[..., :n_h, :]
+    xcorr = np.fft.irfft(xcorr, n=fshape[1], axis=-1)[..., :n_w]
+
+    # energy of the frame under the template at every shift, from the border
+    # columns and the cumulative sum along the height
+    sq = frames**2
+    left = np.zeros(frames.shape[:-1] + (n_w,))
+    left[..., 1:] = np.cumsum(sq[..., :n_w - 1], axis=-1)
+    right = np.zeros(frames.shape[:-1] + (n_w,))
+    right[..., :-1] = np.cumsum(sq[..., :w - 1:-1], axis=-1)[..., ::-1]
+    rows = np.zeros(frames.shape[:-2] + (h_i + 1, n_w))
+    rows[..., 1:, :] = np.cumsum(np.sum(sq, axis=-1)[..., None] - left - right, axis=-2)
+    energy = rows[..., h:h + n_h, :] - rows[..., :n_h, :]
+
+    return xcorr / np.sqrt(np.maximum(energy, 0) * np.asarray(templ_energy)[..., None, None])
+
+
+def _shifts_from_xcorr(res, ms_h, ms_w):
+    """
+    Vectorized version of the peak search and gaussian subpixel refinement
+    performed frame by frame in extract_shifts
+
+    Parameters
+    ----------
+    res: ndarray, (..., 2*ms_h+1, 2*ms_w+1) correlation surfaces
+    ms_h, ms_w: maximum shifts along height and width
+
+    Returns
+    -------
+    shifts: ndarray, (..., 2) shifts in x and y
+    xcorrs: ndarray, (..., 1) average correlation with the template
+    """
+    n_h, n_w = res.shape[-2:]
+    lead = res.shape[:-2]
+    flat = res.reshape((-1, n_h * n_w))
+    frames = np.arange(flat.shape[0])
+    sh_x, sh_y = np.unravel_index(np.argmax(flat, axis=1), (n_h, n_w))
+
+    def log_res(i, j):
+        return np.log(flat[frames, np.clip(i, 0, n_h - 1) * n_w + np.clip(j, 0, n_w - 1)])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_xm1_y = log_res(sh_x - 1, sh_y)
+        log_xp1_y = log_res(sh_x + 1, sh_y)
+        log_x_ym1 = log_res(sh_x, sh_y - 1)
+        log_x_yp1 = log_res(sh_x, sh_y + 1)
+        four_log_xy = 4 * log_res(sh_x, sh_y)
+        sub_x = (log_xm1_y - log_xp1_y) / (2 * log_xm1_y - four_log_xy + 2 * log_xp1_y)
+        sub_y = (log_x_ym1 - log_x_yp1) / (2 * log_x_ym1 - four_log_xy + 2 * log_x_yp1)
+
+    # if max is internal, use the gaussian peak registration
+    internal = (0 < sh_x) & (sh_x < 2 * ms_h - 1) & (0 < sh_y) & (sh_y < 2 * ms_w - 1)
+    sh_x_n = -(sh_x - ms_h + np.where(internal, sub_x, 0))
+    sh_y_n = -(sh_y - ms_w + np.where(internal, sub_y, 0))
+
+    shifts = np.stack([sh_x_n, sh_y_n], axis=-1).reshape(lead + (2,))
+    xcorrs = np.mean(flat, axis=1).reshape(lead + (1,))
+
+    return shifts, xcorrs
+
+
+class lazy_movie(object):
+    """
+    Movie stored in a file (memory mapped npy or mmap file, hdf5 dataset or tif pages) that is read only
+    when and where it is needed. Slicing returns a calblitz.movie with the selected frames and pixels,
+    chunk iteration and reductions read one chunk of frames at a time.
+
+    lazy_movie(frames, fr=None, start_time=0, file_name=None, meta_data=None, handle=None)
+
+    Example of usage
+    ----------
+    m = calblitz.load('file.hdf5', fr=30, lazy=True)
+    first = m[:1000, 10:-10, 10:-10]
+    mean_img = m.zproject(method='mean')
+
+    Parameters
+    ----------
+    frames: array-like (T, d1, d2) (np.memmap, h5py dataset or tif pages, see _open_frames)
+    fr: frame rate
+    start_time: time beginning movie
+    file_name: name of the file
+    meta_data: dictionary including any custom meta data
+    handle: open file handle, closed by close()
+    """
+    def __init__(self, frames, fr=None, start_time=0, file_name=None, meta_data=None, handle=None):
+        if fr is None:
+            raise Exception('You need to specify the frame rate')
+
+        self.frames = frames
+        self.fr = np.double(fr)
+        self.start_time = np.double(start_time)
+        self.file_name = file_name if type(file_name) is list else [file_name]
+        self.meta_data = meta_data if type(meta_data) is list else [meta_data]
+        self.handle = handle
+
+    @classmethod
+    def from_file(cls, file_name, fr=None, start_time=0, meta_data=None, var_name_hdf5='mov', subindices=None, n_threads=1):
+        """
+        Open a tif, hdf5, npy or mmap file (see load)
+        """
+        frames, handle = _open_frames(file_name, var_name_hdf5=var_name_hdf5, n_threads=n_threads)
+        if os.path.splitext(file_name)[1] == '.hdf5':
+            attrs = dict(frames.attrs)
+            fr = attrs.get('fr', fr) if fr is None else fr
+            start_time = attrs.get('start_time', start_time)
+            if 'meta_data' in attrs:
+                meta_data = cpk.loads(attrs['meta_data'])
+
+        mov = cls(frames, fr=fr, start_time=start_time, file_name=file_name, meta_data=meta_data, handle=handle)
+        if subindices is not None:
+            mov.frames = _subindexed_frames(frames, subindices)
+
+        return mov
+
+    @property
+    def shape(self):
+        return tuple(self.frames.shape)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.frames.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+
+        if isinstance(self.frames, (np.ndarray, h5py.Dataset)):
+            arr = self.frames[key]
+        else:
+            arr = self.frames[key[0]]
+            rest = key[1:] if np.isscalar(key[0]) else (slice(None),) + key[1:]
+            arr = arr[rest]
+
+        arr = np.array(arr)
+        if arr.ndim == 3:
+            return movie(arr, fr=self.fr, start_time=self.start_time, file_name=self.file_name, meta_data=self.meta_data)
+
+        return arr
+
+    def iter_chunks(self, chunk_frames=1000, prefetch=0):
+        """
+        Iterate over the movie reading chunk_frames frames at a time
+
+        Parameters
+        ----------
+        chunk_frames: number of frames of each chunk
+        prefetch: number of chunks read ahead by a background thread while the
+                  current one is processed (0 to read each chunk when requested)
+
+        Returns
+        -------
+        generator of calblitz.movie
+        """
+        bounds = [(idx, idx + chunk_frames) for idx in range(0, self.shape[0], chunk_frames)]
+        return _prefetch_chunks(lambda b: self[b[0]:b[1]], bounds, prefetch)
+
+    def __iter__(self):
+        for chunk in self.iter_chunks(chunk_frames=100, prefetch=1):
+            for frame in chunk:
+                yield frame
+
+    def load(self):
+        """
+        Read the whole movie in memory
+
+        Returns
+        -------
+        calblitz.movie
+        """
+        return self[:]
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def to_2D(self, order='F'):
+        """
+        Pixels x time view of the movie. For memory mapped files stored in the order requested
+        (e.g. the mmap files of save_memmap in Fortran order) no data is read
+        """
+        [T,d1,d2] = self.shape
+        if isinstance(self.frames, np.ndarray):
+            return np.reshape(self.frames, (T, d1 * d2), order=order)
+        return self.load().to_2D(order=order)
+
+    def zproject(self, method='mean', cmap=pl.cm.gray, aspect='auto', chunk_frames=1000, **kwargs):
+        """
+        Compute and plot projection across time, reading chunk_frames frames at a time
+        ('median' reads blocks of rows of all the frames instead)
+
+        method: String
+            'mean','median','std'
+
+        **kwargs: dict
+            arguments to imagesc
+        """
+        if method == 'median':
+            T, d1, d2 = self.shape
+            rows = max(1, int(chunk_frames * d1 / T))
+            zp = []
+            for r in range(0, d1, rows):
+                if isinstance(self.frames, (np.ndarray, h5py.Dataset)):
+                    block = self[:, r:r + rows, :]
+                else:
+                    # tif pages are decoded whole, the rows of the block are filled from chunks of frames
+                    # (the file is read once per block, only one chunk and one block are in memory)
+                    block = np.zeros((T, min(rows, d1 - r), d2), dtype=self.dtype)
+                    for idx, chunk in enumerate(self.iter_chunks(chunk_frames)):
+                        block[idx * chunk_frames:idx * chunk_frames + len(chunk)] = chunk[:, r:r + rows, :]
+                zp.append(np.median(block, axis=0))
+            zp = np.concatenate(zp, axis=0)
+        elif method in ('mean', 'std'):
+            n, mean, m2 = reduce(_merge_moments, (_frame_moments(np.asarray(c, dtype=np.float32))
+                                                  for c in self.iter_chunks(chunk_frames)), (0, 0, 0))
+            zp = mean if method == 'mean' else np.sqrt(m2 / n)
+        else:
+            raise Exception('Method not implemented')
+
+        pl.imshow(zp,cmap=cmap,aspect=aspect,**kwargs)
+        return zp
+
+    def extract_traces_from_masks(self, masks, chunk_frames=1000):
+        """
+        Parameters
+        ----------------------
+        masks: array, 3D with each 2D slice bein a mask (integer or fractional)
+        chunk_frames: number of frames read at a time
+
+        Outputs
+        ----------------------
+        traces: array, 2D of fluorescence traces
+        """
+        T,h,w = self.shape
+        nA,_,_ = masks.shape
+        A = np.reshape(masks,(nA,h*w))
+        pixelsA = np.sum(A,axis=1)
+        A = A/pixelsA[:,None] # obtain average over ROI
+        traces = np.concatenate([np.dot(A, np.reshape(c, (len(c), h*w)).T).T for c in self.iter_chunks(chunk_frames)], axis=0)
+        return trace(traces, fr=self.fr, start_time=self.start_time, file_name=self.file_name, meta_data=self.meta_data)
+
+    def local_correlations(self, eight_neighbours=False, chunk_frames=1000):
+        """
+        Compute local correlations, accumulating the moments of the pixels and of the pairs
+        of neighbours chunk_frames frames at a time (see movie.local_correlations)
+
+        Returns
+        -------
+        rho M x N matrix, cross-correlation with adjacent pixel
+        """
+        # pairs of neighbours: vertical, horizontal and the two diagonals
+        pairs = [lambda a: (a[...,:-1,:], a[...,1:,:]), lambda a: (a[...,:,:-1], a[...,:,1:]),
+                 lambda a: (a[...,1:,:-1], a[...,:-1,1:]), lambda a: (a[...,:-1,:-1], a[...,1:,1:])]
+        n = 0
+        for c in self.iter_chunks(chunk_frames):
+            # centered moments of the chunk, merged with those of the previous chunks
+            # (numerically stable, see _merge_moments)
+            c = np.asarray(c, dtype=np.float64)
+            n_c = len(c)
+            mean_c = np.mean(c, axis=0)
+            c -= mean_c
+            m2_c = np.sum(c ** 2, axis=0)
+            co_c = [np.sum(x * y, axis=0) for x, y in (pair(c) for pair in pairs)]
+            if n == 0:
+                n, mean, m2, co = n_c, mean_c, m2_c, co_c
+                continue
+
+            delta = mean_c - mean
+            weight = 1. * n * n_c / (n + n_c)
+            co = [co_a + co_b + x * y * weight for co_a, co_b, (x, y) in zip(co, co_c, (pair(delta) for pair in pairs))]
+            m2 = m2 + m2_c + delta ** 2 * weight
+            mean = mean + delta * n_c / (n + n_c)
+            n += n_c
+
+        rho_h, rho_w, rho_d1, rho_d2 = [co_p / np.sqrt(x * y) for co_p, (x, y) in zip(co, (pair(m2) for pair in pairs))]
+
+        return _neighbours_correlations(rho_h, rho_w, rho_d1, rho_d2, eight_neighbours)
+
+    def extract_shifts(self, template=None, chunk_frames=1000, prefetch=1, **kwargs):
+        """
+        Estimate the shifts of all the frames, reading chunk_frames frames at a time while the previous
+        chunk is registered (see movie.extract_shifts, all the chunks are registered to the same template)
+
+        Parameters
+        ----------
+        template: template the frames are registered to, if None the bin median of the first chunk
+        kwargs: parameters of movie.extract_shifts
+
+        Returns
+        -------
+        shifts, xcorrs
+        """
+        shifts, xcorrs = [], []
+        for chunk in self.iter_chunks(chunk_frames, prefetch=prefetch):
+            chunk = np.asanyarray(chunk, dtype=np.float32)
+            if template is None:
+                template = chunk.bin_median()
+            sh, xc = chunk.extract_shifts(template=template, **kwargs)[:2]
+            shifts += list(sh)
+            xcorrs += list(xc)
+
+        return shifts, xcorrs
+
+    def apply_shifts(self, shifts, out=None, chunk_frames=1000, prefetch=1, **kwargs):
+        """
+        Apply precomputed shifts chunk by chunk (see movie.apply_shifts), writing the corrected frames to out
+
+        Parameters
+        ----------
+        shifts: shifts of all the frames
+        out: preallocated (T, d1, d2) array, memmap or hdf5 dataset (see map_chunks)
+        kwargs: parameters of movie.apply_shifts
+
+        Returns
+        -------
+        out
+        """
+        shifts = list(shifts)
+        chunks = self.iter_chunks(chunk_frames, prefetch=prefetch)
+
+        def apply_chunk(idx_chunk):
+            idx, chunk = idx_chunk
+            idx *= chunk_frames
+            return np.asanyarray(chunk, dtype=np.float32).apply_shifts(shifts[idx:idx + len(chunk)], **kwargs)
+
+        return map_chunks(apply_chunk, enumerate(chunks), out=out)
+
+    def resize(self, fx=1, fy=1, interpolation=cv2.INTER_AREA, out=None, chunk_frames=1000, prefetch=1):
+        """
+        Resize the frames chunk by chunk (see movie.resize), writing them to out (see map_chunks)
+        """
+        return map_chunks(lambda c: c.resize(fx=fx, fy=fy, interpolation=interpolation),
+                          self.iter_chunks(chunk_frames, prefetch=prefetch), out=out)
+
+    def bilateral_blur_2D(self, out=None, chunk_frames=1000, prefetch=1, **kwargs):
+        """
+        Bilateral filtering chunk by chunk (see movie.bilateral_blur_2D), writing the frames to out (see map_chunks)
+        """
+        return map_chunks(lambda c: np.asanyarray(c, dtype=np.float32).bilateral_blur_2D(**kwargs),
+                          self.iter_chunks(chunk_frames, prefetch=prefetch), out=out)
+
+    def gaussian_blur_2D(self, out=None, chunk_frames=1000, prefetch=1, **kwargs):
+        """
+        Gaussian blur chunk by chunk (see movie.gaussian_blur_2D), writing the frames to out (see map_chunks)
+        """
+        return map_chunks(lambda c: c.gaussian_blur_2D(**kwargs),
+                          self.iter_chunks(chunk_frames, prefetch=prefetch), out=out)
+
+    def median_blur_2D(self, out=None, chunk_frames=1000, prefetch=1, **kwargs):
+        """
+        Median blur chunk by chunk (see movie.median_blur_2D), writing the frames to out (see map_chunks)
+        """
+        return map_chunks(lambda c: c.median_blur_2D(**kwargs),
+                          self.iter_chunks(chunk_frames, prefetch=prefetch), out=out)
+
+
+class _subindexed_frames(object):
+    """
+    Array-like view of a subset of the frames of another array-like (see lazy_movie)
+    """
+    def __init__(self, frames, subindices):
+        self.frames = frames
+        self.idx = np.arange(len(frames))[subindices]
+        self.shape = (len(self.idx),) + tuple(frames.shape[1:])
+        self.dtype = frames.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        keys = self.idx[idx]
+        if np.isscalar(keys):
+            return self.frames[keys]
+        # h5py requires increasing and unique indices
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        arr = np.asarray(self.frames[uniq.tolist()])
+        return arr[inverse]
+
+
+def load(file_name,fr=None,start_time=0,meta_data=None,subindices=None,shape=None,var_name_hdf5='mov',lazy=False,n_threads=1):
+    '''
+    load movie from file.
+
+    Parameters
+    -----------
+    file_name: string
+        name of file. Possible extensions are tif, avi, npy, (npz and hdf5 are usable only if saved by calblitz)
+    fr: float
+        frame rate
+    start_time: float
+        initial time for frame 1
+    meta_data: dict
+        same as for calblitz.movie
+    subindices: iterable indexes
+        for loading only portion of the movie. For tif files (slices, strides or lists of
+        indices) only the requested pages are decoded
+    shape: tuple of two values
+        dimension of the movie along x and y if loading from a two dimensional numpy array
+    var_name_hdf5: str
+        name of the dataset to load from hdf5 files (e.g. one channel written by motion_correct_channels)
+    lazy: bool
+        if True (tif, hdf5, npy and mmap files only) return a lazy_movie, that reads from the file
+        only the frames and pixels it is sliced with
+    n_threads: int
+        number of threads decoding the pages of tif files
+
+    Returns
+    -------
+    mov: calblitz.movie (calblitz.lazy_movie if lazy)
+
+    '''
+    if lazy:
+        if not os.path.exists(file_name):
+            raise Exception('File not found!')
+        return lazy_movie.from_file(file_name, fr=fr, start_time=start_time, meta_data=meta_data,
+                                    var_name_hdf5=var_name_hdf5, subindices=subindices, n_threads=n_threads)
+
+    # case we load movie from file
+    if os.path.exists(file_name):
+
+        name, extension = os.path.splitext(file_name)[:2]
+
+        if extension == '.tif' or extension == '.tiff':  # load avi file
+            if subindices is not None or n_threads > 1:
+                frames = _tiff_frames(file_name, n_threads=n_threads)
+                try:
+                    input_arr = frames[subindices if subindices is not None else slice(None)]
+                finally:
+                    frames.close()
+            else:
+                input_arr = imread(file_name)
+            input_arr = np.squeeze(input_arr)
+
+#            with pims.open(file_name) as f:
+#                if len(f.frame_shape)==3:
+#                    for ext_fr in f:
+#                        if subindices is None:
+#                            input_arr = np.array(ext_fr)
+#                        else:
+#                            input_arr = np.array([ext_fr[j] for j in subindices])
+#                elif len(f.frame_shape)==2:
+#                        if subindices is None:
+#                            input_arr = np.array(f)
+#                        else:
+#                            input_arr = np.array([f[j] for j in subindices])
+#                else:
+#                    raise Exception('The input file has an unknown numberof dimensions')
+
+            # necessary for the way pims work with tiffs
+#            input_arr = input_arr[:,::-1,:]
+
+        elif extension == '.avi': # load avi file
+            #raise Exception('Use sintax mov=cb.load(filename)')
+            input_arr = None
+            counter = 0
+            for chunk in iter_avi(file_name, fr=fr, subindices=subindices):
+                if input_arr is None:
+                    input_arr = np.zeros((chunk.n_frames,) + chunk.shape[1:], dtype=np.uint8)
+                input_arr[counter:counter + len(chunk)] = chunk
+                counter += len(chunk)
+
+            if input_arr is None:
+                raise Exception('No frames could be read')
+            input_arr = input_arr[:counter]
+
+        elif extension == '.npy': # load npy file
+            if subindices is not None:
+                input_arr=np.load(file_name)[subindices]
+            else:
+                input_arr=np.load(file_name)
+            if input_arr.ndim==2:
+                if shape is not None:
+                    d,T=np.shape(input_arr)
+                    d1,d2=shape
+                    input_arr=np.transpose(np.reshape(input_arr,(d1,d2,T),order='F'),(2,0,1))
+                else:
+                    raise Exception('Loaded vector is 2D , you need to provide the shape parameter')
+
+        elif extension == '.mat': # load npy file
+            input_arr=loadmat(file_name)['data']
+            input_arr=np.rollaxis(input_arr,2,-3)
+            if subindices is not None:
+                input_arr=input_arr[subindices]
+
+
+        elif extension == '.npz': # load movie from saved file
+            if subindices is not None:
+                raise Exception('Subindices not implemented')
+            with np.load(file_name) as f:
+                return movie(**f)
+
+        elif extension== '.hdf5':
+            with h5py.File(file_name, "r") as f:
+                attrs=dict(f[var_name_hdf5].attrs)
+                attrs['meta_data']=cpk.loads(attrs['meta_data'])
                 if subindices is None:
 #                    fr=f['fr'],start_time=f['start_time'],file_name=f['file_name']
-                    return movie(f['mov'],**attrs)
+                    return movie(f[var_name_hdf5],**attrs)
+                elif isinstance(subindices, slice):
+                    # read by hyperslab
+                    return movie(f[var_name_hdf5][subindices],**attrs)
                 else:
-                    return movie(f['mov'][subindices],**attrs)
+                    return movie(_subindexed_frames(f[var_name_hdf5],subindices)[:],**attrs)
         elif extension == '.mmap':
+            # copy on write view of the file, frames and pixels time series are read only when accessed
+            # and modifications stay in memory
+            input_arr=load_memmap(file_name, mode='c')
+            if subindices is not None:
+                input_arr=input_arr[subindices]
 
-            filename=os.path.split(file_name)[-1]
-            fpart=filename.split('_')[1:-1]
-            d1,d2,d3,T,order=int(fpart[-9]),int(fpart[-7]),int(fpart[-5]),int(fpart[-1]),fpart[-3]
-            Yr=np.memmap(filename,mode='r',shape=(d1*d2,T),dtype=np.float32,order=order)
-            print 'mmap'
-
-            return movie(to_3D(np.array(Yr).T,(T,d1,d2),order=order),fr=fr)
+            return movie(input_arr,fr=fr,start_time=start_time,file_name=file_name,meta_data=meta_data)
         else:
             raise Exception('Unknown file type')
     else:
@@ -1127,22 +2392,803 @@ def load(file_name,fr=None,start_time=0,meta_data=None,subindices=None,shape=Non
 
 def load_movie_chain(file_list, fr=None, start_time=0,
                      meta_data=None, subindices=None,
-                     bottom=0, top=0, left=0, right=0):
+                     bottom=0, top=0, left=0, right=0, n_threads=1, out_file=None):
     ''' load movies from list of file names
     file_list: list of file names in string format
     other parameters as in load_movie except
     bottom, top, left, right to load only portion of the field of view
+    n_threads: number of files read at the same time
+    out_file: if not None, npy file in which the movie is written (and memory mapped) instead of RAM
+
+    The shapes of the files are read first from their headers (see movie_info), then the output is
+    allocated once and each file is opened, read, cropped, directly in its slice of it and closed
+    '''
+    infos = [movie_info(f) for f in file_list]
+
+    frs = [fr if fr is not None else info['fr'] for info in infos]
+    if any(f_r != frs[0] for f_r in frs):
+        raise ValueError('Frame rates of input vectors \
+                        do not match. You cannot concatenate movies with \
+                        different frame rates.')
+
+    frames = []
+    for info in infos:
+        T = info['n_frames']
+        frames.append(len(np.arange(T)[subindices]) if subindices is not None else T)
+
+    shapes = set((info['shape'][-2] - top - bottom, info['shape'][-1] - left - right) for info in infos)
+    if len(shapes) > 1:
+        raise Exception('All the movies must have the same size')
+    d1, d2 = shapes.pop()
+    offsets = np.cumsum([0] + frames)
+    dtype = np.result_type(*[info['dtype'] for info in infos])
+
+    if out_file is None:
+        mov = np.zeros((offsets[-1], d1, d2), dtype=dtype)
+    else:
+        mov = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype, shape=(offsets[-1], d1, d2))
+
+    attrs = [None] * len(file_list)
+
+    def read_file(idx):
+        f = file_list[idx]
+        # when possible only the requested frames and pixels are read
+        lazy = os.path.splitext(f)[1] in ('.tif', '.tiff', '.hdf5', '.npy', '.mmap')
+        src = load(f, fr=frs[idx], start_time=start_time, meta_data=meta_data, subindices=subindices, lazy=lazy)
+        try:
+            h, w = src.shape[-2:]
+            if len(src.shape) == 3:
+                mov[offsets[idx]:offsets[idx + 1]] = src[:, top:h-bottom, left:w-right]
+            else:
+                # read the frame (e.g. from a hdf5 dataset) before adding the time axis
+                mov[offsets[idx]:offsets[idx + 1]] = np.asarray(src[top:h-bottom, left:w-right])[np.newaxis]
+            attrs[idx] = (src.start_time, src.file_name, src.meta_data)
+        finally:
+            if isinstance(src, lazy_movie):
+                src.close()
+
+    if n_threads > 1:
+        pool = ThreadPool(n_threads)
+        try:
+            list(tqdm(pool.imap_unordered(read_file, range(len(file_list))), total=len(file_list)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(read_file, tqdm(range(len(file_list))))
+
+    return movie(mov, fr=frs[0], start_time=attrs[0][0],
+                 file_name=[fn for at in attrs for fn in at[1]],
+                 meta_data=[md for at in attrs for md in at[2]])
+
+
+def motion_correct_file(file_name, fr, out_file=None, max_shift_w=5, max_shift_h=5,
+                        template=None, num_frames_template=None, chunk_frames=1000,
+                        method='opencv', interpolation='cubic', n_threads=1, var_name_hdf5='mov',
+                        return_metrics=False):
+    '''
+    Motion correct a movie that does not fit in memory. The template is built
+    from a strided subsample of the file, then chunks of frames are read,
+    registered and written to the output file one at a time.
+
+    Parameters
+    -----------
+    file_name: string
+        movie to correct (tif, hdf5, npy or mmap)
+    fr: float
+        frame rate
+    out_file: string
+        output file, hdf5 or npy (written as a memory mapped array).
+        If None it is file_name with suffix _mc.hdf5
+    max_shift_w,max_shift_h: int
+        maximum pixel shifts allowed when correcting in the width and height direction
+    template: ndarray
+        if a good template for frame by frame correlation exists it can be passed
+    num_frames_template: int
+        number of frames of the subsample used to build the template
+    chunk_frames: int
+        number of frames held in memory at any time
+    method, interpolation, n_threads:
+        see movie.extract_shifts and movie.apply_shifts
+    return_metrics: bool
+        if True also return the quality metrics of movie.motion_correct, accumulated chunk by chunk
+
+    Returns
+    -------
+    out_file: name of the motion corrected file
+    shifts: shifts in x and y for each frame
+    xcorrs: cross correlation of each frame with the template
+    template: the template used
+    metrics: (only if return_metrics) dict of quality metrics
+    '''
+    apply_method = 'opencv' if method == 'fft' else method
+    frames, handle = _open_frames(file_name, var_name_hdf5=var_name_hdf5)
+    f_out = None
+    try:
+        T, d1, d2 = frames.shape
+
+        template, min_val = _subsample_template(frames, fr, max_shift_w, max_shift_h, template=template,
+                                                num_frames_template=num_frames_template, method=method,
+                                                interpolation=interpolation, n_threads=n_threads)
+
+        if out_file is None:
+            out_file = os.path.splitext(file_name)[0] + '_mc.hdf5'
+
+        extension = os.path.splitext(out_file)[1]
+        if extension == '.hdf5':
+            f_out = h5py.File(out_file, 'w')
+            mov_out = f_out.create_dataset('mov', (T, d1, d2), dtype=np.float32)
+            mov_out.attrs['fr'] = fr
+            mov_out.attrs['start_time'] = 0
+            mov_out.attrs['file_name'] = [file_name]
+            mov_out.attrs['meta_data'] = cpk.dumps([None])
+        elif extension == '.npy':
+            mov_out = np.lib.format.open_memmap(out_file, mode='w+', dtype=np.float32, shape=(T, d1, d2))
+        else:
+            raise Exception('Output must be hdf5 or npy')
+
+        shifts = []
+        xcorrs = []
+        corr = []
+        moments = (0, 0, 0)
+        for idx in range(0, T, chunk_frames):
+            print 'Frames %i-%i' % (idx, min(idx + chunk_frames, T))
+            chunk = movie(np.array(frames[idx:idx + chunk_frames], dtype=np.float32), fr=fr)
+            chunk -= min_val
+            sh, xc, chunk_metrics = chunk.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=template, method=method, n_threads=n_threads, return_metrics=True)
+            chunk = chunk.apply_shifts(sh, interpolation=interpolation, method=apply_method, n_threads=n_threads)
+            chunk += min_val
+            if return_metrics:
+                moments = _merge_moments(moments, _frame_moments(chunk, n_threads))
+            mov_out[idx:idx + len(chunk)] = chunk
+            shifts += sh
+            xcorrs += xc
+            corr.append(chunk_metrics['corr'])
+
+        if extension == '.npy':
+            mov_out.flush()
+            del mov_out
+
+    finally:
+        if handle is not None:
+            handle.close()
+        if f_out is not None:
+            f_out.close()
+
+    if return_metrics:
+        metrics = quality_metrics(*moments)
+        metrics['corr'] = np.concatenate(corr)
+        return out_file, shifts, xcorrs, template, metrics
+
+    return out_file, shifts, xcorrs, template
+
+
+def motion_correct_channels(ref, others, fr, out_file=None, channel_names=None, shifts=None,
+                            max_shift_w=5, max_shift_h=5, template=None, num_frames_template=None,
+                            chunk_frames=1000, method='opencv', interpolation='cubic', n_threads=1,
+                            var_name_hdf5='mov'):
     '''
-    mov = []
-    for f in tqdm(file_list):
-        m = load(f, fr=fr, start_time=start_time,
-                 meta_data=meta_data, subindices=subindices)
-        if m.ndim == 2:
-            m = m[np.newaxis, :, :]
-        tm, h, w = np.shape(m)
-        m = m[:, top:h-bottom, left:w-right]
-        mov.append(m)
-    return ts.concatenate(mov, axis=0)
+    Register a reference channel and apply the same shifts to other channels (or movies derived
+    from the same acquisition), in a single pass over chunks of frames. The warp matrix of each frame
+    is computed once and used for all the channels. All the corrected channels are written to one
+    hdf5 file, one dataset per channel.
+
+    Parameters
+    -----------
+    ref: string or movie
+        reference channel (tif, hdf5, npy or mmap file, or a movie/ndarray already in memory)
+    others: list of strings or movies
+        channels to which the shifts of ref are applied, with the same number of frames as ref
+    fr: float
+        frame rate
+    out_file: string
+        hdf5 output file. If None it is the name of ref with suffix _mc.hdf5 (ref must be a file)
+    channel_names: list of strings
+        names of the datasets of the output file, one for ref and one for each of the others.
+        Default ch0, ch1, ...
+    shifts: list of tuples
+        shifts in x and y of each frame. If provided the reference is not registered again and
+        only the shifts are applied (e.g. to the output of a previous call or of movie.motion_correct)
+    max_shift_w,max_shift_h,template,num_frames_template,chunk_frames,method,interpolation,n_threads,var_name_hdf5:
+        see motion_correct_file
+
+    Returns
+    -------
+    out_file: name of the hdf5 file, datasets can be loaded with load(out_file, var_name_hdf5=name)
+    shifts: shifts in x and y for each frame
+    xcorrs: cross correlation of each frame with the template (None if shifts were provided)
+    template: the template used (None if shifts were provided)
+    '''
+    sources = [ref] + list(others)
+    if channel_names is None:
+        channel_names = ['ch%d' % i for i in range(len(sources))]
+
+    if len(channel_names) != len(sources):
+        raise Exception('One name per channel is required')
+
+    if out_file is None:
+        if not isinstance(ref, basestring):
+            raise Exception('out_file is required when the reference is not a file')
+        out_file = os.path.splitext(ref)[0] + '_mc.hdf5'
+
+    if os.path.splitext(out_file)[1] != '.hdf5':
+        raise Exception('Output must be hdf5')
+
+    interp_flags = {'nearest': cv2.INTER_NEAREST, 'linear': cv2.INTER_LINEAR, 'cubic': cv2.INTER_CUBIC,
+                    'area': cv2.INTER_AREA, 'lanczos4': cv2.INTER_LANCZOS4}
+    if interpolation not in interp_flags:
+        raise Exception('Interpolation method not available')
+
+    handles = []
+    f_out = None
+    try:
+        channels = []
+        for src in sources:
+            if isinstance(src, basestring):
+                frames, handle = _open_frames(src, var_name_hdf5=var_name_hdf5)
+                handles.append(handle)
+            else:
+                frames = src
+            channels.append(frames)
+
+        T, d1, d2 = channels[0].shape
+        for frames in channels[1:]:
+            if len(frames) != T:
+                raise Exception('All the channels must have the same number of frames')
+
+        xcorrs = None
+        if shifts is None:
+            template, min_val = _subsample_template(channels[0], fr, max_shift_w, max_shift_h, template=template,
+                                                    num_frames_template=num_frames_template, method=method,
+                                                    interpolation=interpolation, n_threads=n_threads)
+            shifts = []
+            xcorrs = []
+        else:
+            if len(shifts) != T:
+                raise Exception('One shift per frame is required')
+            template = None
+
+        f_out = h5py.File(out_file, 'w')
+        outs = []
+        for name, frames, src in zip(channel_names, channels, sources):
+            dset = f_out.create_dataset(name, (T,) + tuple(frames.shape[1:]), dtype=np.float32)
+            dset.attrs['fr'] = fr
+            dset.attrs['start_time'] = 0
+            dset.attrs['file_name'] = [src if isinstance(src, basestring) else '']
+            dset.attrs['meta_data'] = cpk.dumps([None])
+            outs.append(dset)
+
+        # offset of each channel, so that the borders uncovered by the shifts are at the level of the background
+        offsets = [None] * len(channels)
+        for idx in range(0, T, chunk_frames):
+            print 'Frames %i-%i' % (idx, min(idx + chunk_frames, T))
+            chunks = [np.array(frames[idx:idx + chunk_frames], dtype=np.float32) for frames in channels]
+            for ch, chunk in enumerate(chunks):
+                if offsets[ch] is None:
+                    offsets[ch] = np.min(np.mean(chunk, axis=0))
+                chunk -= offsets[ch]
+
+            if xcorrs is not None:
+                sh, xc = movie(chunks[0] + offsets[0] - min_val, fr=fr).extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                                                                     template=template, method=method, n_threads=n_threads)
+                shifts += sh
+                xcorrs += xc
+
+            _warp_channels(chunks, shifts[idx:idx + len(chunks[0])], interp_flags[interpolation], n_threads=n_threads)
+
+            for ch, chunk in enumerate(chunks):
+                chunk += offsets[ch]
+                outs[ch][idx:idx + len(chunk)] = chunk
+
+    finally:
+        for handle in handles:
+            if handle is not None:
+                handle.close()
+        if f_out is not None:
+            f_out.close()
+
+    return out_file, shifts, xcorrs, template
+
+
+class online_registration(object):
+    """
+    Register chunks of frames, in temporal order, to a template that is updated with the
+    registered frames. Each update costs O(frame) per frame, so it can be used as the
+    registration step of a live acquisition loop:
+
+        reg = online_registration(fr, max_shift_w=10, max_shift_h=10)
+        for frames in acquisition:
+            frames_mc, shifts, xcorrs = reg.register(frames)
+
+    The template is either an exponential running mean of the registered frames (update='mean')
+    or a running estimate of their median (update='median'), in which each frame moves every pixel of the
+    template by a fixed step towards its own value.
+    Each chunk is offset by the minimum of its mean, as the movie in movie.motion_correct
+    """
+    def __init__(self, fr, max_shift_w=5, max_shift_h=5, template=None, update='mean', alpha=0.01,
+                 method='opencv', interpolation='cubic', n_threads=1):
+        """
+        Parameters
+        ----------
+        fr: float, frame rate
+        max_shift_w,max_shift_h: maximum pixel shifts allowed when correcting in the width and height direction
+        template: initial template. If None it is computed from the first chunk, which should
+                  contain at least a few tens of frames
+        update: 'mean' or 'median'
+        alpha: weight of each new frame in the running mean. For the median, the step is alpha
+               times the mean absolute deviation of the initial template from its median
+        method, interpolation, n_threads: see movie.extract_shifts and movie.apply_shifts
+        """
+        if update not in ('mean', 'median'):
+            raise Exception('Unknown template update')
+
+        self.fr = fr
+        self.max_shift_w = max_shift_w
+        self.max_shift_h = max_shift_h
+        self.template = None if template is None else np.array(template, dtype=np.float32)
+        self.update = update
+        self.alpha = alpha
+        self.method = method
+        self.apply_method = 'opencv' if method == 'fft' else method
+        self.interpolation = interpolation
+        self.n_threads = n_threads
+        self.min_val = None
+        self.median_step = None
+        self.n_frames = 0
+
+    def register(self, frames):
+        """
+        Register a chunk of frames to the current template and update the template with them
+
+        Parameters
+        ----------
+        frames: array (T, d1, d2)
+
+        Returns
+        -------
+        chunk: motion corrected frames (movie)
+        shifts: shifts in x and y for each frame
+        xcorrs: cross correlation of each frame with the template
+        """
+        chunk = movie(np.array(frames, dtype=np.float32), fr=self.fr)
+        # adjust the movie so that values are non negative, the offset follows the bleaching
+        self.min_val = np.min(np.mean(chunk, axis=0))
+        chunk -= self.min_val
+
+        if self.template is None:
+            templ = chunk.bin_median(window=min(10, len(chunk)))
+            shifts, xcorrs = chunk.extract_shifts(max_shift_w=self.max_shift_w, max_shift_h=self.max_shift_h,
+                                                  template=templ, method=self.method, n_threads=self.n_threads)
+            self.template = chunk.copy().apply_shifts(shifts, interpolation=self.interpolation, method=self.apply_method,
+                                                      n_threads=self.n_threads).bin_median(window=min(10, len(chunk))).astype(np.float32)
+
+        shifts, xcorrs = chunk.extract_shifts(max_shift_w=self.max_shift_w, max_shift_h=self.max_shift_h,
+                                              template=self.template, method=self.method, n_threads=self.n_threads)
+        chunk = chunk.apply_shifts(shifts, interpolation=self.interpolation, method=self.apply_method, n_threads=self.n_threads)
+
+        for frame in chunk:
+            self._update_template(frame)
+
+        chunk += self.min_val
+        self.n_frames += len(chunk)
+
+        return chunk, shifts, xcorrs
+
+    def _update_template(self, frame):
+        """
+        In place update of the template with one registered frame
+        """
+        if self.update == 'mean':
+            cv2.accumulateWeighted(np.asarray(frame), self.template, self.alpha)
+        else:
+            if self.median_step is None:
+                self.median_step = self.alpha * np.mean(np.abs(self.template - np.median(self.template)))
+            self.template += self.median_step * np.sign(frame - self.template)
+
+
+def _subsample_template(frames, fr, max_shift_w, max_shift_h, template=None, num_frames_template=None,
+                        method='opencv', interpolation='cubic', n_threads=1):
+    """
+    Build the template of a movie from a strided subsample of its frames, the way motion_correct does
+
+    Parameters
+    ----------
+    frames: array-like (T, d1, d2), only the frames of the subsample are read
+    template: if not None only the offset is computed
+    other parameters: see motion_correct_file
+
+    Returns
+    -------
+    template: template of the frames minus min_val
+    min_val: offset subtracted from the frames to make their mean non negative
+    """
+    T, d1, d2 = frames.shape
+    apply_method = 'opencv' if method == 'fft' else method
+
+    if num_frames_template is None:
+        num_frames_template = 10e7/(d1*d2)
+
+    frames_to_skip = int(np.maximum(1, T/num_frames_template))
+    submov = movie(np.array(frames[::frames_to_skip], dtype=np.float32), fr=fr)
+    # adjust the movie so that values are non negative
+    min_val = np.min(np.mean(submov, axis=0))
+    submov -= min_val
+
+    if template is None:  # if template is not provided it is created from the subsample
+        templ = submov.bin_median()
+        shifts, xcorrs = submov.extract_shifts(max_shift_w=max_shift_w, max_shift_h=max_shift_h, template=templ, method=method, n_threads=n_threads)
+        submov = submov.apply_shifts(shifts, interpolation=interpolation, method=apply_method, n_threads=n_threads)
+        template = submov.bin_median()
+
+    return template, min_val
+
+
+def _warp_channels(chunks, shifts, interpolation, n_threads=1):
+    """
+    Shift in place the frames of several channels, building the warp matrix of each frame once
+
+    Parameters
+    ----------
+    chunks: list of float32 arrays (T, d1, d2) with the same number of frames
+    shifts: shifts in x and y for each of the T frames
+    interpolation: cv2.INTER_XXX flag
+    n_threads: see _map_frame_chunks
+    """
+    def warp_frames(chunk):
+        start, stop = chunk
+        for i in range(start, stop):
+            sh_x_n, sh_y_n = shifts[i]
+            M = np.float32([[1, 0, sh_y_n], [0, 1, sh_x_n]])
+            for frames in chunks:
+                h, w = frames.shape[1:]
+                frames[i] = cv2.warpAffine(frames[i], M, (w, h), flags=interpolation)
+
+    _map_frame_chunks(warp_frames, len(shifts), n_threads)
+
+
+def iter_avi(file_name, fr=None, subindices=None, step=1, roi=None, resize=None, chunk_frames=1000, seek=True):
+    """
+    Read an avi file chunk by chunk, decoding only the frames that are needed. Frames are
+    selected with subindices and step, cropped to roi and resized while they are read, so
+    that only one chunk of the decimated movie is held in memory
+
+    Parameters
+    ----------
+    file_name: string, avi file
+    fr: frame rate of the file, if None it is read from the file
+    subindices: frames to read (slice, or increasing list of indices), default all
+    step: keep one every step of the selected frames
+    roi: (top, bottom, left, right), number of pixels removed from each border of the frames
+         (same convention as load_movie_chain)
+    resize: factor by which the (cropped) frames are resized
+    chunk_frames: number of frames of each chunk
+    seek: if True frames more than 100 frames ahead are reached with CAP_PROP_POS_FRAMES. With
+          codecs using keyframes (e.g. mpeg4, h264) seeking may land a few frames off the
+          requested one; if False all the frames before each selected one are grabbed, which
+          is exact but slower for sparse selections
+
+    Returns
+    -------
+    generator of calblitz.movie (uint8, first channel of the video) with frame rate fr/step.
+    Each chunk has the attribute n_frames, total number of frames that will be read
+    """
+    cap = cv2.VideoCapture(file_name)
+    try:
+        length = int(cap.get(_cap_prop('FRAME_COUNT')))
+        if fr is None:
+            fr = cap.get(_cap_prop('FPS'))
+
+        idx = np.arange(length)
+        if subindices is not None:
+            idx = idx[subindices]
+        idx = idx[::step]
+        if np.any(np.diff(idx) <= 0):
+            raise Exception('Subindices must be increasing')
+
+        pos = 0
+        chunk = []
+        for count, k in enumerate(idx):
+            if seek and k - pos > 100:
+                # far frames are reached by seeking, near ones by skipping them without decoding
+                cap.set(_cap_prop('POS_FRAMES'), k)
+                pos = k
+            while pos < k:
+                cap.grab()
+                pos += 1
+
+            ret, frame = cap.read()
+            pos += 1
+            if not ret:
+                break
+
+            frame = frame[:, :, 0]
+            if roi is not None:
+                top, bottom, left, right = roi
+                frame = frame[top:frame.shape[0] - bottom, left:frame.shape[1] - right]
+            if resize is not None:
+                frame = cv2.resize(frame, None, fx=resize, fy=resize, interpolation=cv2.INTER_AREA)
+            chunk.append(frame)
+
+            if len(chunk) == chunk_frames or count == len(idx) - 1:
+                mov = movie(np.array(chunk), fr=fr / step, file_name=file_name)
+                mov.n_frames = len(idx)
+                chunk = []
+                yield mov
+
+        if len(chunk):
+            mov = movie(np.array(chunk), fr=fr / step, file_name=file_name)
+            mov.n_frames = len(idx)
+            yield mov
+
+    finally:
+        # When everything done, release the capture
+        cap.release()
+
+
+def _cap_prop(name):
+    """
+    cv2.VideoCapture property (opencv 2 names as fallback)
+    """
+    try:
+        return getattr(cv2, 'CAP_PROP_' + name)
+    except AttributeError:
+        return getattr(cv2.cv, 'CV_CAP_PROP_' + name)
+
+
+def memmap_file_name(base_name, d1, d2, T, order='F'):
+    """
+    Name of the mmap file storing a movie of T frames of d1 x d2 pixels as a pixels x time
+    float32 array in the given order (the dimensions are parsed back by load_memmap)
+    """
+    return base_name + '_d1_%d_d2_%d_d3_%d_order_%s_frames_%d_.mmap' % (d1, d2, 1, order, T)
+
+
+def _memmap_shape(file_name):
+    """
+    (d1, d2, T, order) of a mmap file, parsed from its name (see memmap_file_name)
+    """
+    fpart = os.path.split(file_name)[-1].split('_')[1:-1]
+    d1, d2, T, order = int(fpart[-9]), int(fpart[-7]), int(fpart[-1]), fpart[-3]
+    if order not in ('C', 'F'):
+        raise Exception('Order must be C or F')
+    return d1, d2, T, order
+
+
+def load_memmap(file_name, mode='r'):
+    """
+    Memory map a mmap file as a (T, d1, d2) array, without reading or copying any data.
+    Pixels are ordered in the file as by movie.to_2D(order), so the pixels x time array
+    of the file is np.reshape(mov, (T, d1*d2), order=order).T, also a view
+
+    Parameters
+    ----------
+    file_name: string, mmap file (see memmap_file_name)
+    mode: mode of np.memmap ('r', 'r+' or 'c')
+
+    Returns
+    -------
+    np.memmap view (T, d1, d2) float32
+    """
+    d1, d2, T, order = _memmap_shape(file_name)
+    if order == 'F':
+        # pixel i + j*d1 of frame t is at (i + j*d1) + t*d1*d2
+        return np.memmap(file_name, mode=mode, dtype=np.float32, shape=(T, d2, d1)).transpose(0, 2, 1)
+    else:
+        # pixel i*d2 + j of frame t is at (i*d2 + j)*T + t
+        return np.memmap(file_name, mode=mode, dtype=np.float32, shape=(d1, d2, T)).transpose(2, 0, 1)
+
+
+def save_memmap(file_names, base_name='Yr', order='F', idx_xy=None, resize_fact=(1, 1, 1), remove_init=0,
+                var_name_hdf5='mov', dview=None, n_threads=1):
+    """
+    Write a list of movies to a single mmap file (pixels x time float32, see memmap_file_name),
+    cropping, resizing and removing the initial frames of each movie while it is written.
+    The output shape is computed from the headers of the files, then each file is loaded,
+    processed and written into its block of frames in parallel
+
+    Parameters
+    ----------
+    file_names: list of movie files (tif, hdf5, npy, mmap or avi), concatenated in this order
+    base_name: output file name without the dimensions and extension
+    order: 'F' (the frames are contiguous) or 'C' (the time series of the pixels are contiguous)
+    idx_xy: tuple of slices (rows, columns) cropping the frames
+    resize_fact: (fx, fy, fz), factors passed to movie.resize
+    remove_init: number of frames to remove at the beginning of each file
+    var_name_hdf5: name of the dataset when reading hdf5 files
+    dview: ipyparallel view, the files are processed by its engines
+    n_threads: if dview is None, number of threads processing the files
+
+    Returns
+    -------
+    name of the mmap file
+    """
+    if order not in ('C', 'F'):
+        raise Exception('Order must be C or F')
+
+    fx, fy, fz = resize_fact
+    lengths = []
+    for f in file_names:
+        T, d1, d2 = movie_info(f, var_name_hdf5=var_name_hdf5)['shape']
+        if idx_xy is not None:
+            d1, d2 = len(range(d1)[idx_xy[0]]), len(range(d2)[idx_xy[1]])
+        lengths.append(int(fz * (T - remove_init)))
+
+    d1, d2 = int(d1 * fx), int(d2 * fy)
+    offsets = np.cumsum([0] + lengths)
+    out_file = memmap_file_name(base_name, d1, d2, offsets[-1], order=order)
+    # create the file, the blocks are filled by the workers
+    np.memmap(out_file, mode='w+', dtype=np.float32, shape=(d1 * d2, offsets[-1]), order=order).flush()
+
+    pars = [(f, out_file, start, remove_init, idx_xy, resize_fact, var_name_hdf5)
+            for f, start in zip(file_names, offsets[:-1])]
+    if dview is not None:
+        dview.map_sync(_save_memmap_block, pars)
+    elif n_threads > 1:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(_save_memmap_block, pars)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(_save_memmap_block, pars)
+
+    return out_file
+
+
+def _save_memmap_block(pars):
+    """
+    Load one movie, crop and resize it and write it into its block of frames of a mmap file
+    (see save_memmap)
+    """
+    file_name, out_file, start, remove_init, idx_xy, resize_fact, var_name_hdf5 = pars
+    m = load(file_name, fr=1, subindices=slice(remove_init, None), var_name_hdf5=var_name_hdf5)
+    if idx_xy is not None:
+        m = m[:, idx_xy[0], idx_xy[1]]
+    m = m.resize(*resize_fact)
+
+    mov = load_memmap(out_file, mode='r+')
+    mov[start:start + m.shape[0]] = m
+    mov.flush()
+    del mov
+    return file_name
+
+
+def movie_info(file_name, var_name_hdf5='mov'):
+    """
+    Shape and data type of the movie stored in a file, reading only its header
+
+    Parameters
+    ----------
+    file_name: string, tif, hdf5, npy, mmap, avi, npz (saved by calblitz) or mat file
+    var_name_hdf5: name of the dataset when reading hdf5 files
+
+    Returns
+    -------
+    dict with the shape (T, d1, d2), the number of frames, the data type and the frame rate
+    stored in the file (hdf5 and npz files, None for the other formats)
+    """
+    extension = os.path.splitext(file_name)[1]
+    fr = None
+    if extension == '.avi':
+        cap = cv2.VideoCapture(file_name)
+        shape = tuple(int(cap.get(_cap_prop(p))) for p in ('FRAME_COUNT', 'FRAME_HEIGHT', 'FRAME_WIDTH'))
+        cap.release()
+        dtype = np.uint8
+
+    elif extension == '.npz':
+        with np.load(file_name) as f:
+            # header of the array in the archive
+            fp = f.zip.open('input_arr.npy')
+            version = np.lib.format.read_magic(fp)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, _, dtype = read_header(fp)
+            fr = float(f['fr'])
+
+    elif extension == '.mat':
+        # stored as (d1, d2, T)
+        variables = dict((name, (sh, cls)) for name, sh, cls in whosmat(file_name))
+        shape, cls = variables['data']
+        shape = (shape[2],) + tuple(shape[:2])
+        dtype = {'double': np.float64, 'single': np.float32, 'logical': np.bool}.get(cls, cls)
+
+    else:
+        frames, handle = _open_frames(file_name, var_name_hdf5=var_name_hdf5)
+        try:
+            shape, dtype = tuple(frames.shape), frames.dtype
+            if extension == '.hdf5' and 'fr' in frames.attrs:
+                fr = float(frames.attrs['fr'])
+        finally:
+            if handle is not None:
+                handle.close()
+
+    return {'shape': tuple(shape), 'n_frames': shape[0] if len(shape) == 3 else 1, 'dtype': None if dtype is None else np.dtype(dtype), 'fr': fr}
+
+
+def _open_frames(file_name, var_name_hdf5='mov', n_threads=1):
+    """
+    Open a movie file for reading chunks of frames without loading all of it
+
+    Parameters
+    ----------
+    file_name: string, tif, hdf5, npy or mmap file
+    var_name_hdf5: name of the dataset when reading hdf5 files
+    n_threads: number of threads decoding the pages of tif files
+
+    Returns
+    -------
+    frames: array-like (T, d1, d2) that reads from disk only the frames it is sliced with
+    handle: file handle to close when done (None if nothing needs to be closed)
+    """
+    extension = os.path.splitext(file_name)[1]
+
+    if extension == '.tif' or extension == '.tiff':
+        frames = _tiff_frames(file_name, n_threads=n_threads)
+        return frames, frames
+
+    elif extension == '.hdf5':
+        f = h5py.File(file_name, 'r')
+        return f[var_name_hdf5], f
+
+    elif extension == '.npy':
+        return np.load(file_name, mmap_mode='r'), None
+
+    elif extension == '.mmap':
+        return load_memmap(file_name), None
+
+    else:
+        raise Exception('Unknown file type')
+
+
+class _tiff_frames(object):
+    """
+    Read only array-like access to the pages of a tif file, decoding only the pages
+    it is sliced with. Only the headers of the pages are read when it is created.
+    Uncompressed pages are read directly into the output array, by n_threads threads
+    with their own file handle, other pages are decoded by tifffile
+    """
+    def __init__(self, file_name, n_threads=1):
+        self.file_name = file_name
+        self.tf = TiffFile(file_name)
+        self.shape = (len(self.tf.pages),) + tuple(self.tf.pages[0].shape[-2:])
+        self.dtype = self.tf.pages[0].dtype
+        self.n_threads = n_threads
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, idx):
+        keys = np.arange(self.shape[0])[idx]
+        if np.isscalar(keys):
+            return self.tf.pages[keys].asarray()
+
+        out = np.zeros((len(keys),) + self.shape[1:], dtype=self.dtype)
+        if len(keys) == 0:
+            return out
+
+        contiguous = [self.tf.pages[k].is_contiguous for k in keys]
+        if not all(contiguous) or any(bytecount != out[0].nbytes for _, bytecount in contiguous):
+            out[:] = np.reshape(self.tf.asarray(key=keys.tolist()), out.shape)
+            return out
+
+        # uncompressed pages are read straight into the output
+        def read_pages(chunk):
+            start, stop = chunk
+            with open(self.file_name, 'rb') as f:
+                for j in range(start, stop):
+                    f.seek(contiguous[j][0])
+                    f.readinto(out[j])
+
+        # starting the threads is not worth it for a few pages
+        _map_frame_chunks(read_pages, len(keys), self.n_threads if len(keys) >= 100 else 1)
+
+        if np.dtype(self.dtype).newbyteorder(self.tf.byteorder) != np.dtype(self.dtype).newbyteorder('='):
+            out.byteswap(True)
+
+        return out
+
+    def close(self):
+        self.tf.close()
 
 
 def to_3D(mov2D,shape,order='F'):
@@ -34,7 +34,7 @@ for file in os.listdir("./"):
         fnames.append(file)
 fnames.sort()
 print fnames  
-_,d1,d2=np.shape(cb.load(fnames[0][:-3]+'hdf5',subindices=range(3),fr=10))
+_,d1,d2=cb.movies.movie_info(fnames[0][:-3]+'hdf5')['shape']
 st=time.time()
 n_processes = np.maximum(psutil.cpu_count() - 2,1) # roughly number of cores on your machine minus 1
 #print 'using ' + str(n_processes) + ' processes'
@@ -30,7 +30,7 @@ except:
 from scipy.io import loadmat,savemat
 
 import tifffile
-from tifffile import imsave
+from tifffile import imsave, TiffWriter
 
 if tifffile.__version__ < '0.7.0':
     raise Exception('You need libtiff version >= 0.7.0, run pip install tifffile --upgrade')
@@ -120,7 +120,7 @@ class timeseries(np.ndarray):
 #        # then just call the parent
 #        return np.ndarray.__array_wrap__(self, out_arr, context)
 #
-    def save(self,file_name):
+    def save(self,file_name,chunks=None,compression=None,compression_opts=None,shuffle=False,dtype=None,append=False,var_name_hdf5='mov'):
         '''
         Save the timeseries in various formats
 
@@ -128,6 +128,22 @@ class timeseries(np.ndarray):
         ----------
         file_name: name of file. Possible formats are tif, avi, npz and hdf5
 
+        the following parameters only apply to hdf5 files
+
+        chunks: layout of the chunks of the dataset, None for contiguous storage, 'frames'
+                (whole frames, fast to read frame by frame e.g. for registration), 'pixels'
+                (small tiles of many frames, fast to read the traces of a few pixels), 'balanced'
+                (tiles of intermediate size), True (chosen by h5py) or a tuple. With chunks
+                the dataset can be extended with append
+        compression: None, 'gzip' or 'lzf' lossless compression (with chunks 'frames' if chunks is None)
+        compression_opts: compression level for gzip (0-9)
+        shuffle: apply the shuffle filter, that improves the compression of integer data
+        dtype: data type of the saved data (e.g. np.uint16 for raw data), default the dtype of the movie.
+               Floating point data are clipped to the range of integer types before the cast
+        append: if True and the dataset exists, append the frames to it, otherwise create it
+                extendable (with chunks 'frames' if chunks is None)
+        var_name_hdf5: name of the dataset
+
         '''
         name,extension = os.path.splitext(file_name)[:2]
         print extension
@@ -135,11 +151,7 @@ class timeseries(np.ndarray):
         if extension == '.tif': # load avi file
     #            raise Exception('not implemented')
 
-            np.clip(self,np.percentile(self,1),np.percentile(self,99.99999),self)
-            minn,maxx = np.min(self),np.max(self)
-            data = 65536 * (self-minn)/(maxx-minn)
-            data = data.astype(np.int32)
-            imsave(file_name, self.astype(np.float32))
+            save_tif(self, file_name)
 
         elif extension == '.npz':
             np.savez(file_name,input_arr=self, start_time=self.start_time,fr=self.fr,meta_data=self.meta_data,file_name=self.file_name)
@@ -168,11 +180,41 @@ class timeseries(np.ndarray):
                 savemat(file_name,{'input_arr':np.rollaxis(self,axis=0,start=3), 'start_time':self.start_time,'fr':self.fr,'meta_data':self.meta_data,'file_name':f_name})
 
         elif extension == '.hdf5':
-            with h5py.File(file_name, "w") as f:
-                dset=f.create_dataset("mov",data=np.asarray(self))
+            data = np.asarray(self)
+            if dtype is not None:
+                if np.issubdtype(dtype, np.integer) and not np.issubdtype(data.dtype, np.integer):
+                    # values out of the range of the integer type would wrap around when cast
+                    info = np.iinfo(dtype)
+                    data = np.clip(data, info.min, info.max)
+                data = data.astype(dtype)
+            if (compression is not None or append) and chunks is None:
+                # with append the dataset is created extendable, so that the next frames can be appended
+                chunks = 'frames'
+
+            with h5py.File(file_name, "a" if append else "w") as f:
+                if append and var_name_hdf5 in f:
+                    dset = f[var_name_hdf5]
+                    if dset.maxshape[0] is not None:
+                        raise Exception('The dataset was saved without chunks and cannot be extended')
+                    if dset.shape[1:] != data.shape[1:]:
+                        raise Exception('The dataset cannot be extended with frames of this shape')
+                    n = dset.shape[0]
+                    dset.resize(n + data.shape[0], axis=0)
+                    dset[n:] = data
+                    return
+
+                if var_name_hdf5 in f:
+                    del f[var_name_hdf5]
+
+                if chunks is None:
+                    dset=f.create_dataset(var_name_hdf5,data=data)
+                else:
+                    dset=f.create_dataset(var_name_hdf5,data=data,maxshape=(None,)+data.shape[1:],
+                                          chunks=hdf5_chunks(data.shape,data.dtype.itemsize,chunks),
+                                          compression=compression,compression_opts=compression_opts,shuffle=shuffle)
                 dset.attrs["fr"]=self.fr
                 dset.attrs["start_time"]=self.start_time
-                dset.attrs["file_name"]=self.file_name
+                dset.attrs["file_name"]=[fn if fn is not None else '' for fn in self.file_name]
                 dset.attrs["meta_data"]=cpk.dumps(self.meta_data)
 
         else:
@@ -180,6 +222,92 @@ class timeseries(np.ndarray):
             raise Exception('Extension Unknown')
 
 
+def save_tif(mov, file_name, dtype=np.float32, percentiles=(1, 99.99999), chunk_frames=1000,
+             n_sample_frames=100, bigtiff=None):
+    """
+    Write a movie to a tif file chunk_frames frames at a time, clipping the intensities to
+    percentiles estimated on n_sample_frames frames evenly spaced in time. The movie is not
+    modified, so it can be a lazy_movie or a memory mapped array
+
+    Parameters
+    ----------
+    mov: array-like (T, d1, d2) that can be sliced along time (movie, np.memmap, lazy_movie)
+    file_name: name of the tif file
+    dtype: np.float32 (clipped values) or np.uint16 (clipped range scaled to 0-65535)
+    percentiles: (low, high) percentiles the intensities are clipped to, None for no clipping
+    chunk_frames: number of frames written at a time
+    n_sample_frames: number of frames the percentiles are estimated on
+    bigtiff: write a BigTIFF file, if None only when the data does not fit a classic tif
+
+    Returns
+    -------
+    name of the file
+    """
+    dtype = np.dtype(dtype)
+    if dtype not in (np.dtype(np.float32), np.dtype(np.uint16)):
+        raise Exception('Only float32 and uint16 tif files are supported')
+
+    T, d1, d2 = mov.shape
+    idx = np.unique(np.linspace(0, T - 1, min(T, n_sample_frames)).astype(np.int))
+    sample = np.asarray(mov[list(idx)], dtype=np.float32)
+    if percentiles is None:
+        minn, maxx = np.min(sample), np.max(sample)
+    else:
+        minn, maxx = np.percentile(sample, percentiles)
+    del sample
+
+    if bigtiff is None:
+        bigtiff = T * d1 * d2 * dtype.itemsize > 2**32 - 2**25
+
+    with TiffWriter(file_name, bigtiff=bigtiff) as tif:
+        for start in range(0, T, chunk_frames):
+            # copy of the chunk, the source is never modified
+            chunk = np.array(mov[start:start + chunk_frames], dtype=np.float32)
+            if percentiles is not None or dtype == np.uint16:
+                np.clip(chunk, minn, maxx, chunk)
+            if dtype == np.uint16:
+                chunk -= minn
+                chunk *= 65535. / max(maxx - minn, np.finfo(np.float32).eps)
+                chunk = np.round(chunk).astype(np.uint16)
+            tif.save(chunk, contiguous=True, metadata=None)
+
+    return file_name
+
+
+def hdf5_chunks(shape, itemsize, layout='frames', chunk_bytes=2**20):
+    """
+    Shape of the chunks of an hdf5 dataset holding a movie (see timeseries.save)
+
+    Parameters
+    ----------
+    shape: shape of the movie (T, d1, d2)
+    itemsize: bytes per pixel
+    layout: 'frames', 'pixels', 'balanced', True or a tuple (returned as is)
+    chunk_bytes: approximate size of a chunk
+
+    Returns
+    -------
+    tuple with the shape of the chunks (True if chosen by h5py)
+    """
+    if layout is True or isinstance(layout, tuple):
+        return layout
+
+    if len(shape) < 3:
+        return True
+
+    T, d1, d2 = shape[:3]
+    if layout == 'frames':
+        tile = (d1, d2)
+    elif layout == 'pixels':
+        tile = (min(d1, 8), min(d2, 8))
+    elif layout == 'balanced':
+        tile = (min(d1, 64), min(d2, 64))
+    else:
+        raise Exception('Unknown chunk layout')
+
+    frames = int(np.clip(chunk_bytes // (tile[0] * tile[1] * itemsize), 1, max(T, 1)))
+    return (frames,) + tile + tuple(shape[3:])
+
 def concatenate(*args, **kwargs):
         """
         Concatenate movies
@@ -18,7 +18,17 @@ import calblitz as cb
 import numpy as np
 from ipyparallel import Client
 import os
+import hashlib
+import errno
+import zipfile
+import tempfile
 import tifffile
+import struct
+import ast
+import json
+import re
+from glob import glob
+from multiprocessing.pool import ThreadPool
 #%%
 def playMatrix(mov,gain=1.0,frate=.033):
     for frame in mov: 
@@ -199,7 +209,7 @@ def pre_preprocess_movie_labeling(dview, file_names, median_filter_size=(2,1,1),
    return file_res
     
 #%%
-def motion_correct_parallel(file_names,fr,template=None,margins_out=0,max_shift_w=5, max_shift_h=5,remove_blanks=False,apply_smooth=False,dview=None):
+def motion_correct_parallel(file_names,fr,template=None,margins_out=0,max_shift_w=5, max_shift_h=5,remove_blanks=False,apply_smooth=False,dview=None,method='opencv',pyramid_levels=0,use_cache=False,cache_dir=None):
     """motion correct many movies usingthe ipyparallel cluster
     Parameters
     ----------
@@ -209,6 +219,14 @@ def motion_correct_parallel(file_names,fr,template=None,margins_out=0,max_shift_
         fr parameters for calcblitz movie 
     margins_out: int
         number of pixels to remove from the borders    
+    method: str
+        shift extraction method passed to movie.motion_correct ('opencv', 'skimage' or 'fft')
+    pyramid_levels: int
+        coarse to fine search, recommended for large max_shift_w and max_shift_h (see movie.extract_shifts)
+    use_cache: bool
+        reuse the shifts computed for the same file and parameters, only applying them (see shifts_cache_file)
+    cache_dir: str
+        folder of the shift cache, if None a folder shifts_cache next to each file
     
     Return
     ------
@@ -216,7 +234,7 @@ def motion_correct_parallel(file_names,fr,template=None,margins_out=0,max_shift_
     """
     args_in=[];
     for f in file_names:
-        args_in.append((f,fr,margins_out,template,max_shift_w, max_shift_h,remove_blanks,apply_smooth))
+        args_in.append((f,fr,margins_out,template,max_shift_w, max_shift_h,remove_blanks,apply_smooth,method,pyramid_levels,use_cache,cache_dir))
         
     try:
         
@@ -259,6 +277,225 @@ def motion_correct_parallel(file_names,fr,template=None,margins_out=0,max_shift_
                                     
     return file_res
 
+#%%
+def _map_parallel(func, args, dview=None, n_threads=4):
+    """
+    map func over args on the engines of dview, or on a pool of n_threads threads when dview is None
+    """
+    if dview is not None:
+        res = dview.map_sync(func, args)
+        dview.results.clear()
+        return res
+
+    if n_threads > 1 and len(args) > 1:
+        pool = ThreadPool(min(n_threads, len(args)))
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    return map(func, args)
+
+def build_global_template(file_names, fr=30, from_npz=True, register=True, max_shift_w=5, max_shift_h=5,
+                          num_frames_template=100, chunk_size=50, method='median', dview=None, n_threads=4):
+    """
+    Build a template common to many movies, holding at most chunk_size per-file templates in memory.
+    The per-file templates are read (or computed) in parallel chunk by chunk, registered to the median
+    of their chunk and reduced to one template per chunk, the chunk templates are then registered
+    and reduced the same way.
+
+    With more than chunk_size files and method='median' the result is a median of the chunk medians,
+    which approximates but is in general not equal to the median of all the templates (the two match
+    when all the files fit in one chunk). Increase chunk_size if the exact median is needed.
+
+    Parameters
+    ----------
+    file_names: list of strings
+        if from_npz, the outputs of motion_correct_parallel (or the names of the npz files holding
+        the template of each movie), otherwise the movies (tif, hdf5, npy or mmap)
+    fr: double
+        frame rate
+    from_npz: bool
+        read the templates from the npz files instead of computing them from the movies
+    register: bool
+        register the templates to each other before reducing them
+    max_shift_w,max_shift_h: int
+        maximum shifts when registering the templates
+    num_frames_template: int
+        number of frames of each movie used to compute its template when from_npz is False
+    chunk_size: int
+        number of templates reduced together
+    method: str
+        'median' or 'mean'
+    dview: ipyparallel view
+        if not None the templates are read or computed by its engines
+    n_threads: int
+        when dview is None, number of threads used to read or compute the templates
+
+    Return
+    ------
+    template: ndarray
+    """
+    if method not in ('median', 'mean'):
+        raise Exception('Unknown reduction method')
+
+    args_in = [(f, fr, from_npz, num_frames_template) for f in file_names]
+
+    chunk_templates = []
+    for idx in range(0, len(args_in), chunk_size):
+        print 'Templates %i-%i' % (idx, min(idx + chunk_size, len(args_in)))
+        templates = _map_parallel(template_from_file, args_in[idx:idx + chunk_size], dview=dview, n_threads=n_threads)
+
+        chunk_templates.append(_reduce_templates(templates, fr, register, max_shift_w, max_shift_h, method))
+
+    return _reduce_templates(chunk_templates, fr, register, max_shift_w, max_shift_h, method)
+
+def template_from_file(arg_in):
+    """
+    Template of one movie, from the npz file saved by motion_correct_parallel or from
+    a strided subsample of the frames of the movie (see build_global_template)
+    """
+    import calblitz as cb
+    import numpy as np
+
+    fname, fr, from_npz, num_frames_template = arg_in
+    if from_npz:
+        if not fname.endswith('npz'):
+            fname = fname + 'npz' if fname.endswith('.') else os.path.splitext(fname)[0] + '.npz'
+        with np.load(fname) as fl:
+            return np.array(fl['template'], dtype=np.float32)
+
+    frames, handle = cb.movies._open_frames(fname)
+    try:
+        frames_to_skip = int(np.maximum(1, len(frames)/num_frames_template))
+        submov = cb.movie(np.array(frames[::frames_to_skip], dtype=np.float32), fr=fr)
+    finally:
+        if handle is not None:
+            handle.close()
+
+    return submov.bin_median(window=min(10, len(submov))).astype(np.float32)
+
+def _reduce_templates(templates, fr, register, max_shift_w, max_shift_h, method):
+    """
+    Median or mean of a list of templates, optionally registered to their median.
+    Applied to chunk templates it gives a median of medians (see build_global_template)
+    """
+    templates = cb.movie(np.array(templates, dtype=np.float32), fr=fr)
+    if register and len(templates) > 1:
+        templates, shifts, xcorrs, _ = templates.motion_correct(max_shift_w=max_shift_w, max_shift_h=max_shift_h,
+                                                                template=np.median(templates, axis=0))
+    if method == 'median':
+        return np.median(templates, axis=0)
+    else:
+        return np.mean(templates, axis=0)
+
+#%%
+def shifts_cache_file(file_name, cache_dir=None, **params):
+    """
+    Name of the file of the shift cache associated to a movie file and a set of registration parameters.
+    The key hashes the absolute path, size and modification time of the file, the template
+    (if not None) and the value of all the parameters.
+
+    Parameters
+    ----------
+    file_name: str
+        movie file the shifts are computed from
+    cache_dir: str
+        folder of the cache, if None the folder shifts_cache next to the movie
+    params: registration parameters (e.g. ref_template, max_shift_w, max_shift_h, method, margins_out)
+            and the identity of the frames that were loaded (frames, see frames_digest)
+
+    Returns
+    -------
+    name of the npz file holding shifts, xcorrs and template
+    """
+    file_name = os.path.abspath(file_name)
+    st = os.stat(file_name)
+    key = hashlib.sha1()
+    key.update(file_name)
+    key.update(str(st.st_size))
+    key.update(repr(st.st_mtime))
+
+    for name in sorted(params.keys()):
+        val = params[name]
+        key.update(name)
+        if val is not None and np.ndim(val) > 1:
+            # templates are hashed on their content
+            key.update(hashlib.sha1(np.ascontiguousarray(val, dtype=np.float32).tostring()).hexdigest())
+        else:
+            key.update(repr(val))
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(file_name), 'shifts_cache')
+
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(file_name))[0] + '_' + key.hexdigest() + '.npz')
+
+def frames_digest(mov, n_frames=10):
+    """
+    Digest of the shape and of n_frames frames evenly spaced in time of a movie. It identifies which
+    frames and pixels of a file were loaded (e.g. subindices or crops) in the key of the shift cache
+
+    Returns
+    -------
+    hexadecimal string
+    """
+    T = mov.shape[0]
+    key = hashlib.sha1(repr(tuple(mov.shape)))
+    for idx in np.unique(np.linspace(0, T - 1, min(T, n_frames)).astype(np.int)):
+        key.update(np.ascontiguousarray(mov[idx], dtype=np.float32).tostring())
+    return key.hexdigest()
+
+def load_shifts_cache(file_name, cache_dir=None, **params):
+    """
+    Retrieve the shifts computed for a movie file with the same registration parameters
+    (see shifts_cache_file)
+
+    Returns
+    -------
+    None if not present in the cache, otherwise
+    shifts, xcorrs, template
+    """
+    fname = shifts_cache_file(file_name, cache_dir=cache_dir, **params)
+    if not os.path.exists(fname):
+        return None
+
+    try:
+        with np.load(fname) as ld:
+            return ld['shifts'].tolist(), ld['xcorrs'].tolist(), ld['template']
+    except (IOError, EOFError, KeyError, ValueError, zipfile.BadZipfile):
+        # missing or corrupt entry (e.g. written by an older, interrupted run), computed again
+        return None
+
+def save_shifts_cache(file_name, shifts, xcorrs, template, cache_dir=None, **params):
+    """
+    Store the shifts computed for a movie file with the given registration parameters
+    (see shifts_cache_file)
+
+    Returns
+    -------
+    name of the cache file
+    """
+    fname = shifts_cache_file(file_name, cache_dir=cache_dir, **params)
+    try:
+        os.makedirs(os.path.dirname(fname))
+    except OSError as e:
+        # the folder may have been created by another engine
+        if e.errno != errno.EEXIST:
+            raise
+
+    # written to a temporary file renamed into place, so readers never see a partial file
+    fd, tmp_name = tempfile.mkstemp(suffix='.npz.tmp', dir=os.path.dirname(fname))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, shifts=shifts, xcorrs=xcorrs, template=template)
+        os.rename(tmp_name, fname)
+    except:
+        os.remove(tmp_name)
+        raise
+
+    return fname
+
 #%%
 def mode_robust(inputData, axis=None, dtype=None):
     """
@@ -324,7 +561,7 @@ def process_movie_parallel(arg_in):
 
     
 
-    fname,fr,margins_out,template,max_shift_w, max_shift_h,remove_blanks,apply_smooth=arg_in
+    fname,fr,margins_out,template,max_shift_w, max_shift_h,remove_blanks,apply_smooth,method,pyramid_levels,use_cache,cache_dir=arg_in
     
     with open(fname[:-4]+'.stout', "a") as log:
         print fname
@@ -344,7 +581,8 @@ def process_movie_parallel(arg_in):
             if margins_out!=0:
                 Yr=Yr[:,margins_out:-margins_out,margins_out:-margins_out] # borders create troubles
             print 'motion correcting'
-            Yr,shifts,xcorrs,template=Yr.motion_correct(max_shift_w=max_shift_w, max_shift_h=max_shift_h,  method='opencv',template=template,remove_blanks=remove_blanks) 
+            Yr,shifts,xcorrs,template=Yr.motion_correct(max_shift_w=max_shift_w, max_shift_h=max_shift_h,  method=method,template=template,remove_blanks=remove_blanks,pyramid_levels=pyramid_levels,
+                                                   use_cache=use_cache,cache_dir=cache_dir,cache_params=dict(margins_out=margins_out,apply_smooth=apply_smooth)) 
             print 'median computing'        
             template=Yr.bin_median()
             print 'saving'  
@@ -362,9 +600,9 @@ def process_movie_parallel(arg_in):
            
 #%% 
 def val_parse(v):
-    # parse values from si tags into python objects if possible
+    # parse values from si tags into python objects if possible (python literals only, nothing is evaluated)
     try:
-        return eval(v)
+        return ast.literal_eval(v)
     except:
         if v == 'true':
             return True
@@ -378,28 +616,225 @@ def val_parse(v):
         else:
             return v
 
-def si_parse(imd):
+def si_parse(imd, keys=None):
 
-    # parse image_description field embedded by scanimage
+    # parse image_description field embedded by scanimage (only the fields in keys if not None)
     imd = imd.split('\n')
     imd = [i for i in imd if '=' in i]
-    imd = [i.split('=') for i in imd]
+    imd = [i.split('=',1) for i in imd]
     imd = [[ii.strip(' \r') for ii in i] for i in imd]
+    if keys is not None:
+        imd = [i for i in imd if i[0] in keys]
     imd = {i[0]:val_parse(i[1]) for i in imd}
     return imd
 
 #%%
-def get_image_description_SI(fname):
-    """Given a tif file acquired with Scanimage it returns a dictionary containing the information in the image description field
-    """
-    image_descriptions=[]
-    tf=tifffile.TiffFile(fname)
-    for idx,pag in enumerate(tf.pages):
-            if idx%1000==0:
-                print(idx)
-    #        i2cd=si_parse(pag.tags['image_description'].value)['I2CData']
-            field=pag.tags['image_description'].value
-            
-            image_descriptions.append(si_parse(field))
-    
-    return image_descriptions
\ No newline at end of file
+def get_image_description_SI(fname, keys=None):
+    """Given a tif file acquired with Scanimage it returns a list with, for each page, a dictionary containing the information in the image description field
+
+    Parameters
+    ----------
+    fname: str
+        tif file
+    keys: list of str
+        if not None, only these fields are parsed (e.g. ['I2CData','frameNumberAcquisition'])
+    """
+    return [si_parse(field, keys=keys) for field in tiff_image_descriptions(fname)]
+
+def tiff_image_descriptions(fname, n_pages=None):
+    """
+    Read the image_description tag of all the pages (or of the first n_pages) of a (Big)TIFF file,
+    walking the IFDs of the file without reading any pixel data or any other tag
+
+    Returns
+    -------
+    list of str, one per page ('' for the pages without description)
+    """
+    descriptions = []
+    with open(fname, 'rb') as f:
+        header = f.read(16)
+        if header[:2] == 'II':
+            bo = '<'
+        elif header[:2] == 'MM':
+            bo = '>'
+        else:
+            raise Exception('Not a tiff file')
+
+        version = struct.unpack(bo + 'H', header[2:4])[0]
+        if version == 42:
+            offset_fmt, count_fmt, entry_fmt, entry_size, inline = 'I', 'H', 'HHII', 12, 4
+            offset = struct.unpack(bo + 'I', header[4:8])[0]
+        elif version == 43:
+            offset_fmt, count_fmt, entry_fmt, entry_size, inline = 'Q', 'Q', 'HHQQ', 20, 8
+            offset = struct.unpack(bo + 'Q', header[8:16])[0]
+        else:
+            raise Exception('Not a tiff file')
+
+        count_size = struct.calcsize(count_fmt)
+        offset_size = struct.calcsize(offset_fmt)
+        while offset and (n_pages is None or len(descriptions) < n_pages):
+            f.seek(offset)
+            n_tags = struct.unpack(bo + count_fmt, f.read(count_size))[0]
+            ifd = f.read(n_tags * entry_size + offset_size)
+            description = ''
+            for idx in range(n_tags):
+                tag, _, count, value = struct.unpack(bo + entry_fmt, ifd[idx * entry_size:(idx + 1) * entry_size])
+                if tag == 270:
+                    if count <= inline:
+                        description = ifd[idx * entry_size + entry_size - inline:][:count]
+                    else:
+                        pos = f.tell()
+                        f.seek(value)
+                        description = f.read(count)
+                        f.seek(pos)
+                    break
+
+            descriptions.append(description.rstrip('\0'))
+            offset = struct.unpack(bo + offset_fmt, ifd[-offset_size:])[0]
+
+    return descriptions
+
+def get_image_description_columns_SI(file_names, keys=('I2CData', 'frameNumberAcquisition'), use_cache=True, dview=None,
+                                     n_threads=4):
+    """
+    Parse the requested fields of the ScanImage image descriptions of many tif files, in parallel.
+    Each file is stored in columns (one array per field with one value per page) and cached in
+    the npz file fname[:-4]+'_SIHeader.npz', that is read again only if the tif file did not change
+
+    Parameters
+    ----------
+    file_names: list of tif files
+    keys: fields to extract
+    use_cache: whether to read and write the cache files
+    dview: ipyparallel view, if not None the files are parsed by its engines
+    n_threads: when dview is None, number of threads parsing the files
+
+    Returns
+    -------
+    list of dict, for each file field -> np.array with one value per page (None if missing)
+    """
+    args = [(fname, tuple(keys), use_cache) for fname in file_names]
+    return _map_parallel(image_description_columns, args, dview=dview, n_threads=n_threads)
+
+def image_description_columns(arg_in):
+    """
+    Columns of the ScanImage image descriptions of one file (see get_image_description_columns_SI)
+
+    Parameters
+    ----------
+    arg_in: tuple (fname, keys, use_cache)
+    """
+    fname, keys, use_cache = arg_in
+    st = os.stat(fname)
+    cache_file = fname[:-4] + '_SIHeader.npz'
+
+    if use_cache and os.path.exists(cache_file):
+        with np.load(cache_file, allow_pickle=True) as ld:
+            if ld['mtime'] == st.st_mtime and ld['size'] == st.st_size and all(k in ld.files for k in keys):
+                return {k: ld[k] for k in keys}
+
+    descriptions = [si_parse(field, keys=keys) for field in tiff_image_descriptions(fname)]
+    columns = {}
+    for k in keys:
+        columns[k] = np.array([d.get(k) for d in descriptions])
+        if columns[k].ndim != 1:
+            # sequences stay one object per page
+            col = np.empty(len(descriptions), dtype=object)
+            col[:] = [d.get(k) for d in descriptions]
+            columns[k] = col
+
+    if use_cache:
+        np.savez(cache_file, mtime=st.st_mtime, size=st.st_size, **columns)
+
+    return columns
+
+#%%
+def update_manifest(folder, pattern='*.tif', fr=None, manifest_name='manifest.json'):
+    """
+    Create or update the manifest of the movies of a folder, a json file recording for each movie its
+    path, shape, dtype, frame rate, number of frames, trial index, and the npz file with its shifts
+    and template (base name + .npz, as saved by process_movie_parallel). Only the movies (or shift
+    files) that are new or changed since the last update are opened, and only their headers are read
+
+    Parameters
+    ----------
+    folder: str
+        folder of the movies
+    pattern: str
+        glob pattern of the movies in the folder
+    fr: float
+        frame rate of the movies, if None read from the ScanImage header of tif files
+    manifest_name: str
+        name of the manifest file in the folder
+
+    Returns
+    -------
+    dict base name of the movie -> entry (see load_manifest)
+    """
+    manifest_file = os.path.join(folder, manifest_name)
+    old = load_manifest(folder, manifest_name=manifest_name)
+    manifest = {}
+    changed = False
+    for fname in sorted(glob(os.path.join(folder, pattern))):
+        base_name = os.path.splitext(os.path.split(fname)[-1])[0]
+        shifts_file = os.path.abspath(os.path.splitext(fname)[0] + '.npz')
+        st = os.stat(fname)
+        shifts_mtime = os.stat(shifts_file).st_mtime if os.path.exists(shifts_file) else None
+
+        entry = old.get(base_name)
+        if entry is None or entry['size'] != st.st_size or entry['mtime'] != st.st_mtime:
+            entry = _manifest_entry(fname, fr)
+            entry['size'], entry['mtime'] = st.st_size, st.st_mtime
+            entry['shifts_mtime'] = -1
+
+        if entry['shifts_mtime'] != shifts_mtime:
+            entry['shifts_file'], entry['template'], entry['n_shifts'] = None, None, None
+            if shifts_mtime is not None:
+                with np.load(shifts_file) as ld:
+                    entry['shifts_file'] = shifts_file
+                    entry['n_shifts'] = len(ld['shifts']) if 'shifts' in ld.files else None
+                    entry['template'] = shifts_file if 'template' in ld.files else None
+            entry['shifts_mtime'] = shifts_mtime
+            changed = True
+
+        manifest[base_name] = entry
+
+    if changed or set(manifest) != set(old):
+        tmp_file = manifest_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.rename(tmp_file, manifest_file)
+
+    return manifest
+
+def load_manifest(folder, manifest_name='manifest.json'):
+    """
+    Read the manifest of a folder (see update_manifest) without touching the movies
+
+    Returns
+    -------
+    dict base name of the movie -> dict with keys path, shape, dtype, fr, n_frames, trial,
+    shifts_file, n_shifts, template, size, mtime, shifts_mtime. Empty if there is no manifest
+    """
+    manifest_file = os.path.join(folder, manifest_name)
+    if not os.path.exists(manifest_file):
+        return {}
+
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+def _manifest_entry(fname, fr=None):
+    """
+    Entry of a movie in the manifest, read from the header of the file (see update_manifest)
+    """
+    info = cb.movies.movie_info(fname)
+    if fr is None and os.path.splitext(fname)[1] in ('.tif', '.tiff'):
+        descr = si_parse(tiff_image_descriptions(fname, n_pages=1)[0], keys=['scanimage.SI.hRoiManager.scanFrameRate'])
+        fr = descr.get('scanimage.SI.hRoiManager.scanFrameRate')
+
+    # trial number of ScanImage file names (..._00NNN_0...), 0 based
+    trial = re.search('_00[0-9][0-9][0-9]_0', os.path.split(fname)[-1])
+
+    return {'path': os.path.abspath(fname), 'shape': [int(d) for d in info['shape']], 'dtype': str(info['dtype']),
+            'fr': None if fr is None else float(fr), 'n_frames': int(info['n_frames']),
+            'trial': None if trial is None else int(trial.group(0)[2:6]) - 1}